@@ -14,6 +14,86 @@ import python_definition
 from textx import metamodel
 
 
+##=========================================================================
+
+##
+# The compiled TextX metamodels, keyed by grammar file path.
+# Compiling a grammar is expensive so we only ever do it once per file
+_metamodels = {}
+
+##
+# Returns the (cached) compiled metamodel for the given grammar file.
+#
+# Every parse is a one-shot parse of a single user input so
+# we turn off memoization (and debugging) in the parser, there is
+# nothing to be gained from the memo tables except memory use
+def _load_metamodel( grammar_file ):
+    mm = _metamodels.get( grammar_file, None )
+    if mm is None:
+        mm = metamodel.metamodel_from_file(
+            grammar_file,
+            memoization = False,
+            debug = False,
+            auto_init_attributes = False )
+        _metamodels[ grammar_file ] = mm
+    return mm
+
+##=========================================================================
+
+##
+# The Representations for token symbols, keyed by the symbol.
+# Symbols repeat a lot in input and Representations are never changed
+# once created, so all concepts for the same symbol share them
+_symbol_representations_cache = {}
+
+##
+# Returns the (cached) tuple of Representations for a token symbol
+def _symbol_representations( symbol ):
+    reps = _symbol_representations_cache.get( symbol, None )
+    if reps is None:
+        reps = (
+            concept.Representation(
+                symbol,
+                level=concept.Representation.LEVEL_INPUT_MORPHISM),
+            concept.Representation(
+                "#|Symbol:{0}|#".format( symbol ),
+                level = concept.Representation.LEVEL_SYSTEM_INFORMATION ) )
+        _symbol_representations_cache[ symbol ] = reps
+    return reps
+
+##=========================================================================
+
+##
+# The handler method names of each BasicGrammarConcept class keyed by
+# ( concept class, grammar object class ).  These are filled in from
+# the class' by-name dispatch tables as grammar classes are first seen
+# (keyed by concept class too since subclasses may have their own
+# tables)
+_expression_handlers_by_class = {}
+_symbol_handlers_by_class = {}
+
+##
+# Looks up the handler for the given object's class by class name
+# in the handlers_by_name dispatch table of the given concept, and
+# remembers it in handlers_by_class so the next object of that class
+# is dispatched on class identity alone.
+#
+# Returns None if there is no handler for the object
+def _class_handler( handlers_by_class, handlers_by_name, concept, obj ):
+    key = ( type(concept), type(obj) )
+    handler = handlers_by_class.get( key, None )
+    if handler is None:
+        handler = handlers_by_name.get( key[1].__name__, None )
+        if handler is not None:
+            handlers_by_class[ key ] = handler
+    return handler
+
+##
+# Returns true iff the given BasicGrammarConcept subclass overrides
+# the named method
+def _overrides( cls, name ):
+    return getattr( cls, name ).im_func is not getattr( BasicGrammarConcept, name ).im_func
+
 ##=========================================================================
 
 ##
@@ -21,14 +101,27 @@ from textx import metamodel
 # to parse user input
 class BasicGrammarConcept( concept.ConceptBase ):
 
+    __slots__ = ( 'grammar_file', )
+
+    ##
+    # The default grammar file used to parse input
+    DEFAULT_GRAMMAR_FILE = 'basic_grammar.tx'
+
     ##
     # Creates a new concept with the given arguments (from ConceptBase)
     def __init__( self,
                   *args,
                   **kw):
+        self.grammar_file = kw.pop( 'grammar_file', self.DEFAULT_GRAMMAR_FILE )
         concept.ConceptBase.__init__( self, *args, **kw )
-        grammar_file = kw.get( 'grammar_file', 'basic_grammar.tx' )
-        self.mm = metamodel.metamodel_from_file( grammar_file )
+
+    ##
+    # The TextX metamodel used to parse input.
+    # This is only looked up when actually needed (on parse) and
+    # is shared between all concepts using the same grammar file
+    @property
+    def mm( self ):
+        return _load_metamodel( self.grammar_file )
 
     ##
     # Parse a raw user input into Concepts.
@@ -45,20 +138,33 @@ class BasicGrammarConcept( concept.ConceptBase ):
         model = self.mm.model_from_str( raw )
 
         # ok, transform parsing model to concepts
+        return self._concepts_from_model( model )
+
+    ##
+    # Parse a batch of raw user inputs into Concepts.
+    #
+    # This is the same as calling parse(...) on each input in turn
+    # but only looks up the metamodel once.
+    # Returns a List[ List[ ConceptBase ] ], one list per raw input
+    def parse_many( self, raws ):
+        mm = self.mm
+        return [ self._concepts_from_model( mm.model_from_str( raw ) )
+                 for raw in raws ]
+
+    ##
+    # Transform a parsed basic_grammar.Program model into a
+    # list of concepts
+    def _concepts_from_model( self, model ):
         concepts = []
+        handlers = self._expression_handlers
         for expr in model.expressions:
-            stype = expr.__class__.__name__
-            if stype == 'Statement':
-                res = self._concepts_from_statement( expr, self )
-                concepts.extend( res )
-            elif stype == 'ContextSwitch':
-                res = self._concepts_from_context_switch( expr, self )
-                concepts.extend( res )
-            elif stype == 'Command':
-                res = self._concepts_from_command( expr, self )
-                concepts.extend( res )
-            else:
+            handler = _class_handler( _expression_handlers_by_class,
+                                      handlers,
+                                      self,
+                                      expr )
+            if handler is None:
                 raise RuntimeError( "Unknown basic_gramma object '{0}'".format( expr ) )
+            concepts.extend( getattr( self, handler )( expr, self ) )
 
         # return the parsed concepts
         return concepts
@@ -66,51 +172,88 @@ class BasicGrammarConcept( concept.ConceptBase ):
 
     ##
     # Parse a basic_grammar.Statement into a list of concepts
+    #
+    # Every symbol is dispatched through the _symbol_handlers table.
+    # Nested statements (BlockSymbols) are the one shortcut: unless a
+    # subclass overrides _block_symbol_concepts or this method, the
+    # nested statement is handled with an explicit stack rather than
+    # recursing through _block_symbol_concepts (which creates the same
+    # concepts). The concept for a nested statement is created as soon
+    # as it is seen so that it keeps its place among its siblings, and
+    # its own symbols are created when popped.
     def _concepts_from_statement( self, statement, parent ):
-        res = []
+
         # first create a concept for hte statement and
         # use it as the parent of all symbol concepts
-        state_parent = BasicGrammarConcept(
-            parent_concept = parent,
-            constituent_concepts = [] )
+        root = self._statement_concept( parent )
 
-        # create the symbol concepts, linked to prent statement
-        for symbol in statement.parts:
-            c = self._symbol_concepts( symbol, state_parent )
-            res.extend( c )
+        # create the symbol concepts, linked to prent statement.
+        # This is the inner loop of parsing so the methods used per
+        # symbol are bound to locals once
+        cls = type(self)
+        inline_blocks = not ( _overrides( cls, '_block_symbol_concepts' )
+                              or _overrides( cls, '_concepts_from_statement' ) )
+        statement_concept = self._statement_concept
+        symbol_handler = self._symbol_handler
+        stack = [ ( statement, root ) ]
+        push = stack.append
+        pop = stack.pop
+        while stack:
+            statement, state_parent = pop()
+            for symbol in statement.parts:
+                handler = symbol_handler( symbol )
+                if inline_blocks and handler == '_block_symbol_concepts':
+                    push( ( symbol.statement,
+                            statement_concept( state_parent ) ) )
+                else:
+                    getattr( self, handler )( symbol, state_parent )
 
         # return the statement concept
-        return [ state_parent ]
+        return [ root ]
+
+    ##
+    # Returns a new, empty, concept for a statement with given parent
+    def _statement_concept( self, parent ):
+        return BasicGrammarConcept(
+            parent_concept = parent,
+            constituent_concepts = [],
+            grammar_file = self.grammar_file )
 
     ##
     # return a list of concepts for hte given symbol
     # using given parent
     def _symbol_concepts( self, symbol, parent ):
-        stype = symbol.__class__.__name__
-        if stype == 'TokenSymbol' or isinstance( symbol, (str,unicode) ) :
-            return [ self._token_symbol_concept( symbol, parent ) ] 
-        elif stype == 'BlockSymbol':
-            return self._block_symbol_concepts( symbol, parent )
-        else:
+        return getattr( self, self._symbol_handler( symbol ) )( symbol, parent )
+
+    ##
+    # Returns the name of the method creating the concepts for the
+    # given symbol (see _symbol_handlers)
+    def _symbol_handler( self, symbol ):
+        handler = _class_handler( _symbol_handlers_by_class,
+                                  self._symbol_handlers,
+                                  self,
+                                  symbol )
+        if handler is None:
             raise RuntimeError( "Unknown basic_grammar.Symbol subtype '{0}'".format( symbol ) )
+        return handler
+
+    ##
+    # Returns a list with the single concept for the given
+    # token symbol with given parent
+    def _token_symbol_concepts( self, symbol, parent ):
+        return [ self._token_symbol_concept( symbol, parent ) ]
 
     ##
     # Returns a new single concept fromgiven symbol (a string)
     # with given parent
     def _token_symbol_concept( self, symbol, parent ):
                         
-        reps = []
-        reps.append( concept.Representation(
-            symbol,
-            level=concept.Representation.LEVEL_INPUT_MORPHISM) )
-        reps.append( concept.Representation(
-            "#|Symbol:{0}|#".format( symbol ),
-            level = concept.Representation.LEVEL_SYSTEM_INFORMATION ) )
+        reps = list( _symbol_representations( symbol ) )
         c = BasicGrammarConcept(
             parent_concept = parent,
             constituent_concepts = [],
-            context = concept.Context(),
-            representations = reps)
+            representations = reps,
+            grammar_file = self.grammar_file )
         return c
 
     ##
@@ -151,9 +294,28 @@ class BasicGrammarConcept( concept.ConceptBase ):
         python_def = python_definition.PythonDefinition(
             concept = c,
             source = context_switch.body )
-        c.context.bind_definition( python_def )
+        c.bind_definition( python_def )
 
         return [ c ]
+
+    ##
+    # Dispatch tables from the basic_grammar class names to the names
+    # of the methods which create the concepts for them (looked up on
+    # the concept so subclasses may override them)
+    _expression_handlers = {
+        'Statement' : '_concepts_from_statement',
+        'ContextSwitch' : '_concepts_from_context_switch',
+        'Command' : '_concepts_from_command',
+    }
+    #
+    # Note: TokenSymbol is a match rule so TextX hands us the plain
+    #       matched string, hence the str/unicode entries
+    _symbol_handlers = {
+        'TokenSymbol' : '_token_symbol_concepts',
+        'BlockSymbol' : '_block_symbol_concepts',
+        'str' : '_token_symbol_concepts',
+        'unicode' : '_token_symbol_concepts',
+    }
     
 ##=========================================================================
 ##=========================================================================
@@ -10,7 +10,6 @@ logger = logging.getLogger( __name__ )
 # This also allows the user to see any prompts from the
 # interpreter and to get metadata about prompts and interpreter
 
-import re
 import sys
 
 import interpreter
@@ -18,6 +17,27 @@ import concept
 
 ##=========================================================================
 
+##
+# The CLI commands of each CLI class, by class
+_cli_commands_by_class = {}
+
+##
+# Returns a dictionary from command name to the method for it
+# (the _command_<name> method) for the given CLI class.
+# This is built once per class by looking through it's methods
+def _cli_commands( cli_class ):
+    commands = _cli_commands_by_class.get( cli_class, None )
+    if commands is None:
+        prefix = "_command_"
+        commands = {}
+        for name in dir( cli_class ):
+            if name.startswith( prefix ):
+                commands[ name[ len(prefix): ] ] = getattr( cli_class, name )
+        _cli_commands_by_class[ cli_class ] = commands
+    return commands
+
+##=========================================================================
+
 ##
 # A command line interface
 class CLI( object ):
@@ -44,16 +64,20 @@ class CLI( object ):
                          instream = sys.stdin,
                          outstream = sys.stdout ):
 
-        try:
+        # prompt hte user by displaying the current
+        # interpreter's current concept
+        interp = None
+        if self.current_interpreter_index is not None:
+            interp = self.interpreters[self.current_interpreter_index]
+            self._show_header( interp,
+                               outstream )
+            self._discard_prompts( interp )
 
-            # prompt hte user by displaying the current
-            # interpreter's current concept
-            if self.current_interpreter_index is not None:
-                self._show_header( self.interpreters[self.current_interpreter_index],
-                                   outstream )
-                self._discard_prompts( self.interpreters[self.current_interpreter_index])
+        line = instream.readline()
 
-            line = instream.readline()
+        # errors evaluating the input are logged (not raised) so the
+        # user can keep going
+        try:
             if line.startswith( ':/' ):
 
                 # grab cli command and evaluate it
@@ -63,29 +87,35 @@ class CLI( object ):
             else:
 
                 # send input to current interpreter
-                self.interpreters[self.current_interpreter_index].interpret(line)
-
-            # cleanup any done interpreters
-            to_remove = []
-            for i, p in enumerate( self.interpreters ):
-                if p.is_done():
-                    to_remove.append( i )
-            if len(to_remove) == len(self.interpreters):
-                self.current_interpreter_index = None
-
-            # shift current interpretes to previous not done one
-            while self.current_interpreter_index is not None and self.current_interpreter_index in to_remove:
-                self.current_interpreter_index -= 1
-                if self.current_interpreter_index < 0:
-                    self.current_interpreter_index = len(self.interpreters) - 1
-
-            # remove done interpreters
-            for i in reversed( to_remove ):
-                del self.interpreters[ i ]
-
-        except:
+                interp.interpret(line)
+
+        except Exception:
             logger.exception("ERROR")
 
+        # cleanup any done interpreters
+        self._remove_done_interpreters()
+
+
+    ##
+    # Removes all done interpreters (in a single pass) and updates the
+    # current interpreter index to the current interpreter, or the
+    # previous not done one if it is done, wrapping around to the last
+    # one (None if all are done)
+    def _remove_done_interpreters( self ):
+        current = self.current_interpreter_index
+        new_current = None
+        survivors = []
+        for i, p in enumerate( self.interpreters ):
+            if not p.is_done():
+                survivors.append( p )
+            if i == current:
+                new_current = len(survivors) - 1
+        if len(survivors) == 0:
+            new_current = None
+        elif current is not None and ( new_current is None or new_current < 0 ):
+            new_current = len(survivors) - 1
+        self.interpreters = survivors
+        self.current_interpreter_index = new_current
 
     ##
     # Discards all prompts for an interpreter by finishing them
@@ -95,49 +125,53 @@ class CLI( object ):
 
     ##
     # Display hte header showing hte user what concept and propmts we are in
+    #
+    # The header is collected and written with a single writelines
     def _show_header( self, interp, outstream ):
-        outstream.write( "===\n" )
-        self._show_concept( interp,
-                            outstream )
-        self._show_prompts( interp,
-                            outstream )
-        outstream.write( "===\n" )
-        outstream.write( "> " )
+        parts = [ "===\n" ]
+        self._concept_lines( interp,
+                             parts )
+        self._prompt_lines( interp,
+                            parts )
+        parts.append( "===\n" )
+        parts.append( "> " )
+        outstream.writelines( parts )
 
 
     ##
-    # Display the currnet concept
-    def _show_concept( self, interp, outstream ):
+    # Adds the display of the currnet concept to parts
+    def _concept_lines( self, interp, parts ):
         string = interp.state.current_concept.preferred_representation().human_friendly()
-        outstream.write( string + "\n" )
+        parts.append( string + "\n" )
 
     ##
-    # Display any prompts
-    def _show_prompts( self, interp, outstream ):
+    # Adds the display of any prompts to parts
+    def _prompt_lines( self, interp, parts ):
         for p in interp.state.prompts:
             string = p.state.current_concept.preferred_representation().human_friendly()
-            outstream.write( "?> " + string + "\n\n" )
+            parts.append( "?> " + string + "\n\n" )
 
 
     ##
     # Evaluate a CLI command
     def _evaluate_command_line( self, cmdline, instream, outstream ):
-        toks = re.split( r'\s+', cmdline )
+        toks = cmdline.split()
         cmd = toks[0]
-        if len(toks) > 1:
-            args = toks[1:]
-        else:
-            args = []
+        args = toks[1:]
 
-        method = "_command_{0}".format( cmd )
-        getattr( self, method )( args, instream, outstream )
+        command = _cli_commands( type(self) ).get( cmd, None )
+        if command is not None:
+            command( self, args, instream, outstream )
+        else:
+            outstream.write( "Unknown command '{0}'\n".format( cmd ) )
 
     ##
     # List interpreters
     def _command_list( self, args, instream, outstream ):
+        current_index = self.current_interpreter_index
         for i, interp in enumerate( self.interpreters ):
             s = "{0}".format( i )
-            if i == self.current_interpreter_index:
+            if i == current_index:
                 s += " *"
             else:
                 s += "  "
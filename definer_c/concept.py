@@ -27,27 +27,33 @@ import collections
 
 ##=========================================================================
 
+##
+# The special key definitions are bound to in a Context.
+# It is interned since it is looked up in every Context we walk
+_DEFINITION_KEY = intern( "%%DEFINITION%%" )
+
 ##
 # A Context is a glorified dictionary with utility functions and a type tag
+#
+# Note: there is no per-instance state beyond the dictionary itself so
+#       we use empty __slots__ to avoid giving every Context a __dict__,
+#       and we use dict's own __init__
 class Context( dict ):
 
-    DEFINITION_KEY = "%%DEFINITION%%"
+    __slots__ = ()
 
-    ##
-    # Initialize the dictionary
-    def __init__( self, *args, **kw ):
-        dict.__init__( self, *args, **kw )
+    DEFINITION_KEY = _DEFINITION_KEY
 
     ##
     # There is a *special* identifier for a "definition" of something,
     # and here we can access it
     def definition_binding(self):
-        return self.get( self.DEFINITION_KEY, None )
+        return dict.get( self, _DEFINITION_KEY, None )
 
     ##
     # bind the definition in this context
     def bind_definition(self,definition):
-        self[ self.DEFINITION_KEY ] = definition
+        dict.__setitem__( self, _DEFINITION_KEY, definition )
 
 ##=========================================================================
 
@@ -55,8 +61,13 @@ class Context( dict ):
 # A Representation is a particular output projection of a Concept.
 # Generally Representations have a way to make themselves "human-friedly"
 # via a unicode string
+#
+# Representations are never changed once created, so the human-friendly
+# string is only computed once
 class Representation( object ):
 
+    __slots__ = ( 'raw', 'level', '_human_friendly' )
+
     ##
     # Some canstant defining the levels of a representation
     LEVEL_HUMAN_SEMMANTICS = 50
@@ -70,22 +81,108 @@ class Representation( object ):
     def __init__( self, raw, level = LEVEL_UNKNOWN ):
         self.raw = raw
         self.level = level
+        self._human_friendly = None
 
     ##
     # Returns a human-friendly version of this Representation
     def human_friendly( self ):
+        s = self._human_friendly
+        if s is not None:
+            return s
 
-        # convert to unicode
-        s = unicode( self.raw )
+        # convert to unicode (if not already)
+        s = self.raw
+        if not isinstance( s, unicode ):
+            s = unicode( s )
 
         # add block if spaces inside string
         if " " in s:
             s = '[[' + s + ']]'
 
+        self._human_friendly = s
         return s
 
 ##=========================================================================
 
+##
+# A Representation whose raw string is only built when it is needed.
+# The raw string is the given format string applied to the given
+# arguments, which saves formatting strings that are never looked at
+class LazyRepresentation( Representation ):
+
+    __slots__ = ( 'raw_format', 'raw_args' )
+
+    ##
+    # Initialize with the format string and its arguments
+    def __init__( self, raw_format, raw_args, level = Representation.LEVEL_UNKNOWN ):
+        self.raw_format = raw_format
+        self.raw_args = raw_args
+        self.level = level
+        self._human_friendly = None
+
+    ##
+    # The raw string, formatted on demand
+    @property
+    def raw( self ):
+        return self.raw_format.format( *self.raw_args )
+
+##=========================================================================
+
+##
+# The Representation of a CommandConcept, which is the command identifier
+# applied to the human friendly forms of it's arguments.
+#
+# Arguments are generally attached to a command after it is created, so
+# unlike other Representations this is built from the command's current
+# arguments whenever it is asked for (and not cached)
+class CommandRepresentation( Representation ):
+
+    __slots__ = ( 'command', )
+
+    ##
+    # Initialize with the CommandConcept being represented
+    def __init__( self, command, level = Representation.LEVEL_HUMAN_SEMMANTICS ):
+        self.command = command
+        self.level = level
+        self._human_friendly = None
+
+    ##
+    # The raw string, built from the current arguments
+    @property
+    def raw( self ):
+        return u"{0}( {1} )".format(
+            self.command.command_identifier,
+            u", ".join([ c.preferred_representation().human_friendly()
+                         for c in self.command.constituent_concepts ]) )
+
+    ##
+    # Returns a human-friendly version of this Representation,
+    # always recomputed since the arguments may have changed
+    def human_friendly( self ):
+        self._human_friendly = None
+        return Representation.human_friendly( self )
+
+##=========================================================================
+
+##
+# The format of the default identifier Representation of every concept
+_ID_REP_FORMAT = intern( "#|id={0}|#" )
+
+##
+# The formats of the typed identifier Representation, by concept type
+_typed_id_rep_formats = {}
+
+##
+# Returns the (interned) format of the typed identifier Representation
+# for concepts of the given type, building it once per type so the
+# type name is not looked up every time one is formatted
+def _typed_id_rep_format( concept_type ):
+    fmt = _typed_id_rep_formats.get( concept_type, None )
+    if fmt is None:
+        fmt = intern( "#|" + concept_type.__name__ + " id={0}|#" )
+        _typed_id_rep_formats[ concept_type ] = fmt
+    return fmt
+
 ##=========================================================================
 
 
@@ -104,18 +201,31 @@ class Representation( object ):
 #
 # Note: by design we always strart iwth a List since there can always be
 #       a choice of size one :)
+#
+# The result is cached on the concept until it's constituents change, so
+# it is shared and must not be modified by callers
 def fully_expand_representations( c ):
-    
-    res = []
-    for r in c.representations:
-        res.append( r.human_friendly() )
-        
+    res = c._expanded_representations
+    if res is None:
+        res = _compute_fully_expanded_representations( c )
+        c._expanded_representations = res
+    return res
+
+##
+# Computes fully_expand_representations(...) for a concept (uncached)
+def _compute_fully_expanded_representations( c ):
+
+    res = [ r.human_friendly() for r in c.representations ]
+
+    # most concepts (such as BoxConcepts) are leaves, and for
+    # those the representations are all there is
+    constituents = c.constituent_concepts
+    if not constituents:
+        return res
+
     # ok, we can also represent this as a lsit of it's constituents
-    if len(c.constituent_concepts) > 0:
-        child_res = []
-        for c0 in c.constituent_concepts:
-            child_res.append( fully_expand_representations( c0 ) )
-        res.append( tuple(child_res) )
+    res.append( tuple([ fully_expand_representations( c0 )
+                        for c0 in constituents ]) )
     return res
 
 ##=========================================================================
@@ -133,83 +243,121 @@ IndexedMatchRep = collections.namedtuple( "IndexedMatchRep",
 # we can back out which part of hte original rep is responsible for
 # the given matching.  Each match= is a list of equality constraint for
 # a single element, so return is List[ IndexedMatchRep ] :)
+#
+# This returns a list of all the flat paths, see
+# iter_flattened_fully_expanded_representations(...) to generate them
+# one at a time instead
 def flatten_fully_expanded_representations( expanded_reps,
-                                            index = [] ):
+                                            index = None ):
+    return list( iter_flattened_fully_expanded_representations(
+        expanded_reps,
+        index = index ) )
+
+##
+# Generates the flat paths of a set of fully expanded representations,
+# one at a time (see flatten_fully_expanded_representations(...) )
+#
+# Note: fully_expand_representations(...) only ever builds plain lists
+#       and tuples, so here (and in any_rep_match(...) ) the structure
+#       is dispatched on the exact type (a pointer compare) rather
+#       than through isinstance(...)
+def iter_flattened_fully_expanded_representations( expanded_reps,
+                                                   index = None ):
+
+    # the index of the top-level is empty
+    if index is None:
+        index = []
 
     # If this is an atom, this is strange so raise error
-    if not isinstance( expanded_reps, (list,tuple) ):
+    t = type( expanded_reps )
+    if t is not list and t is not tuple:
         raise RuntimeError( "Got atom which flattening expanded reps, should not happen" )
 
-    # Ok, if we are a list of atoms (non-lists/tuples) then
-    # we are a flat path so just add to accumulator the choice
-    # and return
-    if isinstance( expanded_reps, list ) and all(map(lambda x: not isinstance( x, (list,tuple) ), expanded_reps)):
-        #logger.info( "Atom-flatten: returning {0}".format( [ expanded_reps ] ) )
-        return [ [ IndexedMatchRep( index=index,
-                                  match= expanded_reps ) ] ]
-
     # if we are a structure choice ( a tuple ) then we
     # just flatten each in order
-    if isinstance( expanded_reps, tuple ):
-
-        # grab flattene for each child
+    if t is tuple:
+
+        # grab flattene for each child.
+        # These are each iterated many times by the product below
+        # so they are materialized (once)
+        #
+        # Note: the debug logging in here is left disabled since it runs
+        #       for every node of the structure; if it is turned back
+        #       on, use lazy %-style arguments so that nothing is formatted
+        #       when INFO is not enabled
         child_flats = []
         for i,x in enumerate(expanded_reps):
             res = flatten_fully_expanded_representations(
                 x,
                 index = index + [i] )
             child_flats.append( res )
-            #logger.info( "Tuple-Flat: child {0} ==> {1}".format(x, res ) )
+            #logger.info( "Tuple-Flat: child %r ==> %r", x, res )
 
         # now build up all product combinations of the flattened children
-        #logger.info( "Tuple-Flat: children_flats = {0}".format( child_flats ) )
-        child_prod = itertools.product( *child_flats )
-        res = []
-        for p in child_prod:
-            path = []
-            for x in p:
-                path.extend( x )
-            res.append( path )
-            #logger.info( "Tuple-Flat: prod = {0}   path ===> {1}".format(p,path ) )
-
-        # return hte sulting acum
-        # logger.info( "Tuple-flat: result {0} ==> {1}".format(
-        #     expanded_reps,
-        #     res ) )
-        return res
+        #logger.info( "Tuple-Flat: children_flats = %r", child_flats )
+        # Every flat path is a list, so the small (common) arities are
+        # simply nested loops concatenating the paths, and only the
+        # general case goes through itertools.product
+        n = len( child_flats )
+        if n == 1:
+            for a in child_flats[0]:
+                yield list( a )
+        elif n == 2:
+            flats_a, flats_b = child_flats
+            for a in flats_a:
+                for b in flats_b:
+                    yield a + b
+        elif n == 3:
+            flats_a, flats_b, flats_c = child_flats
+            for a in flats_a:
+                for b in flats_b:
+                    ab = a + b
+                    for c in flats_c:
+                        yield ab + c
+        else:
+            for p in itertools.product( *child_flats ):
+                path = []
+                for x in p:
+                    path.extend( x )
+                #logger.info( "Tuple-Flat: prod = %r   path ===> %r", p, path )
+                yield path
+        return
+
+    # ok, we are a list so split into the atoms and the tuples
+    # (in a single pass)
+    atoms = []
+    tuples = []
+    for x in expanded_reps:
+        t = type( x )
+        if t is tuple:
+            tuples.append( x )
+        elif t is list:
+
+            # ok, we do not expect any lsits so error if any found
+            raise RuntimeError( "Can not handle nested lists in expanded rep: {0}".format( expanded_reps ) )
+        else:
+            atoms.append( x )
 
-    # ok, we are a list but have list or tuples inside so split into
-    # the atoms and the tuples
-    atoms = filter(lambda x: not isinstance( x, (list,tuple) ), expanded_reps)
-    lists = filter(lambda x: isinstance( x, list), expanded_reps )
-    tuples = filter(lambda x: isinstance( x, tuple), expanded_reps )
-
-    # ok, we do not expect any lsits so error if any found
-    if len(lists) > 0:
-        raise RuntimeError( "Can not handle nested lists in expanded rep: {0}".format( expanded_reps ) )
-
-    # ok, the atoms are all tretes a a single list so grap the flattene
-    # for them as a whole
-    child_flats = []
-    atom_flats = flatten_fully_expanded_representations( atoms,
-                                                         index = index )
-    child_flats.extend( atom_flats )
-    #logger.info( "Mixed-Flat: atom-flats = {0}".format( atom_flats ) )
-
-    # now each individual structure (tuple) is flattened and each will
-    # be accumulated in
+    # Ok, if we are a list of only atoms (non-lists/tuples) then
+    # we are a flat path so just yield the choice
+    # and return
+    if len(tuples) == 0:
+        #logger.info( "Atom-flatten: returning %r", [ expanded_reps ] )
+        yield [ IndexedMatchRep( index=index,
+                                 match= expanded_reps ) ]
+        return
+
+    # ok, the atoms are all tretes a a single list so they
+    # are a single flat path as a whole
+    yield [ IndexedMatchRep( index=index,
+                             match= atoms ) ]
+
+    # now each individual structure (tuple) is flattened and each
+    # of it's paths is a choice as well
     for trep in tuples:
-        res = flatten_fully_expanded_representations( trep,
-                                                      index = index)
-        child_flats.extend( res )
-        #logger.info( "Mixed-Flat: tuple {0} ==> {1}".format(trep,res ) )
-
-    # ok, now for each children's flattened we just accumulate
-    # and return hte accumulation
-    res = []
-    for p in child_flats:
-        res.append( p )
-    return res
+        for p in iter_flattened_fully_expanded_representations( trep,
+                                                                index = index ):
+            yield p
 
 
 ##=========================================================================
@@ -226,16 +374,20 @@ def any_rep_match( expanded_reps, c ):
     # match and exactly match
 
     # structure check
-    if isinstance( expanded_reps, tuple ):
+    t = type( expanded_reps )
+    if t is tuple:
 
         # length of sturecture must match number of chicldren
-        if len( expanded_reps ) != len(c.constituent_concepts):
+        constituents = c.constituent_concepts
+        if len( expanded_reps ) != len( constituents ):
             return False
 
         # ok, lengths match so structure matches, let's dive in
-        # to their euality checks
-        for erep, c0 in zip( expanded_reps,
-                             c.constituent_concepts ):
+        # to their euality checks.
+        # (izip, since we usually stop at the first mismatch there
+        # is no point in building all of the pairs)
+        for erep, c0 in itertools.izip( expanded_reps,
+                                        constituents ):
             match = any_rep_match( erep,
                                    c0 )
             if not match:
@@ -245,11 +397,20 @@ def any_rep_match( expanded_reps, c ):
         return True
 
     # choice check
-    if isinstance( expanded_reps, list ):
+    if t is list:
 
-        # return true if any of them match
+        # return true if any of them match.
+        # Equality choices are checked directly against the set
+        # of the concept's human_friendly strings
+        strings = None
         for erep in expanded_reps:
-            match = any_rep_match( erep, c )
+            et = type( erep )
+            if et is list or et is tuple:
+                match = any_rep_match( erep, c )
+            else:
+                if strings is None:
+                    strings = c.human_friendly_representations()
+                match = erep in strings
             if match:
                 return True
 
@@ -259,15 +420,41 @@ def any_rep_match( expanded_reps, c ):
     # neither tuple nor list, so this is an equality ocnstrain check
     # on the concept's representations.  See if *any* of the
     # representations match
-    for r in c.representations:
-        string = r.human_friendly()
-        match = ( expanded_reps == string )
-        if match:
-            return True
+    return expanded_reps in c.human_friendly_representations()
 
-    # ok, getting here means no representaion equaility matched using
-    # the human_friendly stirng, so no match
-    return False
+##
+# Returns the concepts in the subtree of the given top concept which
+# may match the given fully expanded reps with any_rep_match(...),
+# in pre-order.
+#
+# This is every concept that any_rep_match(...) could be true for
+# (and usually few others), found with the top concept's
+# subtree_rep_index() rather than by trying every concept
+def rep_match_candidates( expanded_reps, top ):
+    index = top.subtree_rep_index()
+    positions = set([])
+    for k in _rep_match_keys( expanded_reps ):
+        positions.update( index.get( k, () ) )
+    subtree = top.subtree_concepts()
+    return [ subtree[ i ] for i in sorted( positions ) ]
+
+##
+# Returns the subtree_rep_index() keys a concept must have at least
+# one of to match the given fully expanded reps: the strings of the
+# equality choices and the lengths of the structure choices
+def _rep_match_keys( expanded_reps ):
+    keys = set([])
+    stack = [ expanded_reps ]
+    while len(stack) > 0:
+        e = stack.pop()
+        t = type( e )
+        if t is list:
+            stack.extend( e )
+        elif t is tuple:
+            keys.add( len( e ) )
+        else:
+            keys.add( e )
+    return keys
 
 ##=========================================================================
 
@@ -277,6 +464,8 @@ def any_rep_match( expanded_reps, c ):
 # constituents to use for each concept
 class SubstructureMatch( object ):
 
+    __slots__ = ( 'concepts', 'constituent_ranges' )
+
     WHOLE_CONCEPT = "+whole+"
 
     ##
@@ -294,6 +483,7 @@ class SubstructureMatch( object ):
 ##
 # Internal submatch sturectu to keep tack of backrefs
 class SubmatchRefs( object ):
+    __slots__ = ( 'flat_rep', 'position', 'indices', 'concept' )
     def __init__( self,
                   flat_rep,
                   position,
@@ -313,81 +503,38 @@ class SubmatchRefs( object ):
 # which represent points where any of the expanded reps
 # match part of the concept
 #
+# The concept and each of it's constituents (recursively, in pre-order)
+# are checked for a full match with the expanded reps. If
+# include_child_submatches is false we stop at the first match found.
+#
+# This walks the concept graph with an explicit stack rather than recursion
 def any_rep_substructure_match( expanded_reps, c, include_child_submatches = True ):
 
     # o, in hte expanded reps a List is treated as a choice (so any one
     # inside must match) and a Tuple is treated as a structure.
-    # Since this is a substructure match we ignore the structure elements
-    # and only consider the *order* of the structure not it's size/bounds
 
     # Ok, we will bascially iterate over the possible substructures
-    # of the concept and see if we substructure match it :)
+    # of the concept and see if we match it :)
     res = []
+    stack = [ c ]
+    while len(stack) > 0:
+        c0 = stack.pop()
 
-    # first try a full match
-    full_match = any_rep_match( expanded_reps, c )
-    if full_match:
+        # try a full match of this (sub)concept
+        if any_rep_match( expanded_reps, c0 ):
 
-        # build up a SubstructureMatch entry for the full match
-        res.append( SubstructureMatch(
-            concepts = [ c ],
-            constituent_ranges = [ SubstructureMatch.WHOLE_CONCEPT ] ) )
+            # build up a SubstructureMatch entry for the full match
+            res.append( SubstructureMatch(
+                concepts = [ c0 ],
+                constituent_ranges = [ SubstructureMatch.WHOLE_CONCEPT ] ) )
 
-    # Ok, if we found a full match and we do not want children submatches
-    # then we are done
-    if full_match and not include_child_submatches:
-        return res
+            # Ok, if we do not want children submatches
+            # then we are done
+            if not include_child_submatches:
+                return res
 
-    # So let us generate a flattened set of representations for
-    # both the expanded representations given (what we are looking *for*)
-    # and the gicen concept (what we are looking *in*).
-    flattened_expanded_reps = flatten_fully_expanded_representations( expanded_reps )
-    flattened_c = flatten_fully_expanded_reps( fully_expand_representations( c ) )
-
-    # triple for-loop time :(
-    # So we will see if any of the flat reps looking *for*
-    # are a match in any of hte flat reps *in*, and we
-    # need to check at all starting points of the *in* reps
-    sub_matches = []
-    for looking_for_flat_rep in flattened_expanded_reps:
-        for looking_in_flat_rep in flattened_c:
-
-            # check size and compute position ranges we need to search in
-            if len(looking_for_flat_rep) > len(looking_in_flat_rep):
-                continue # no match possible
-            max_pos = len(looking_in_flat_rep) - len(looking_for_flat_rep)
-
-            # ok, search starting at every position
-            for pos in xrange( 0, max_pos + 1 ):
-
-                # check if two flat representations match and
-                # store the resulting matching indices
-                in_indices = []
-                for for_check, in_check in zip( looking_for_flat_rep,
-                                                looking_in_flat_rep[pos:] ):
-
-                    # if there is an intersection in the matches we are good
-                    mint = set(for_check.match) & set(in_check.match)
-
-                    # if we find a match, store it
-                    if len(mint) > 0:
-                        sub_matches.append(
-                            SubmatchRefs(
-                                looking_in_flat_rep,
-                                pos,
-                                map(lambda imr: imr.index,
-                                    looking_in_flat_rep[pos:]),
-                                c))
-
-    # ok, now convert internal submatch structures to the actual
-    # results    
-    for subm in sub_matches:
-
-        # resolve the acual concept objects used from
-        # the indices
-        res.append( submatch_ref_to_substructure_match(
-            sumb,
-            c ) )
+        # visit constituents in order
+        stack.extend( reversed( c0.constituent_concepts ) )
 
     # return substructure matches
     return res
@@ -480,20 +627,103 @@ def _get_concept_using_index( parent, index ):
 
 ##=========================================================================
 
+##
+# returns the lowest (deepest) common ancestor of the given concepts,
+# where a concept counts as it's own ancestor.
+# Returns None if the concepts are not all in the same concept graph.
+#
+# This just follows parent links: every concept is first lifted to the
+# depth of the shallowest one, and then they all step up together
+# until they are the same concept
+def lowest_common_ancestor( concepts ):
+    if len(concepts) == 0:
+        return None
+
+    # the depth of each concept
+    depths = []
+    for c in concepts:
+        d = 0
+        p = c.parent_concept
+        while p is not None:
+            d += 1
+            p = p.parent_concept
+        depths.append( d )
+
+    # lift all to the same depth
+    min_depth = min( depths )
+    current = []
+    for c, d in zip( concepts, depths ):
+        while d > min_depth:
+            c = c.parent_concept
+            d -= 1
+        current.append( c )
+
+    # step up together until they meet
+    first = current[0]
+    while first is not None:
+        if all( c is first for c in current ):
+            return first
+        current = [ c.parent_concept for c in current ]
+        first = current[0]
+    return None
+
+##=========================================================================
+
 ##
 # returns a lsit of the human friendly representations at the *leaves*
 # or edges of a concept
+#
+# The result mirrors the constituent structure: a concept with
+# constituents becomes a list of its constituents' results.
+#
+# The result is cached on the concept until it's constituents change,
+# so it is shared and must not be modified by callers
 def leaves_human_reps( c, all_reps=False ):
     if not isinstance( c, ConceptBase ):
         return str(c)
-    if len(c.constituent_concepts) > 0:
-        return map(lambda x: leaves_human_reps(x,all_reps=all_reps),
-                   c.constituent_concepts)
-    res = tuple(map(lambda rep: rep.human_friendly(),
-                    c.representations))
+    cache = c._leaves_human_reps
+    if cache is None:
+        cache = {}
+        c._leaves_human_reps = cache
+    res = cache.get( all_reps, None )
+    if res is None:
+        res = _compute_leaves_human_reps( c, all_reps )
+        cache[ all_reps ] = res
+    return res
+
+##
+# Computes leaves_human_reps(...) for a concept (uncached).
+# This walks the concept graph with an explicit stack rather than recursion
+def _compute_leaves_human_reps( c, all_reps ):
+    if len(c.constituent_concepts) == 0:
+        return _leaf_human_reps( c, all_reps )
+
+    # each stack entry is a list of constituents and the result
+    # list to fill in for them (in order)
+    res = []
+    stack = [ ( c.constituent_concepts, res ) ]
+    while len(stack) > 0:
+        constituents, out = stack.pop()
+        for c0 in constituents:
+            if not isinstance( c0, ConceptBase ):
+                out.append( str(c0) )
+                continue
+            children = c0.constituent_concepts
+            if len(children) > 0:
+                child_out = []
+                out.append( child_out )
+                stack.append( ( children, child_out ) )
+            else:
+                out.append( _leaf_human_reps( c0, all_reps ) )
+    return res
+
+##
+# returns the human friendly representation of a leaf concept,
+# or all of them (as a tuple) if all_reps is true
+def _leaf_human_reps( c, all_reps ):
     if all_reps:
-        return res
-    return res[0]
+        return tuple([ rep.human_friendly() for rep in c.representations ])
+    return c.representations[0].human_friendly()
 
 ##=========================================================================
 
@@ -520,8 +750,24 @@ def leaves_human_reps( c, all_reps=False ):
 # The Representations in the concept are stored in "most preffered" to
 # least preffered order, so by default the first representation will
 # be used whenever a single representation of the concept is needed
+#
+# Note: Concepts are created per parsed symbol so there are a lot of them,
+#       hence they (and their subclasses) use __slots__ rather than
+#       a per-instance __dict__
 class ConceptBase( object ):
 
+    __slots__ = ( 'parent_concept',
+                  'constituent_concepts',
+                  'context',
+                  'representations',
+                  'identifier',
+                  '_possible_definition',
+                  '_expanded_representations',
+                  '_human_friendly_representations',
+                  '_leaves_human_reps',
+                  '_subtree_concepts',
+                  '_subtree_rep_index' )
+
     ##
     # Create a concept with:
     #   a parent
@@ -532,37 +778,51 @@ class ConceptBase( object ):
     def __init__( self,
                   parent_concept,
                   constituent_concepts,
-                  context = Context(),
+                  context = None,
                   representations = None,
                   identifier = None ):
         self.parent_concept = parent_concept
         self.constituent_concepts = constituent_concepts
         self.context = context
+        if self.context is None:
+            self.context = Context()
         self.representations = representations
         self.identifier = identifier
         if self.identifier is None:
             self.identifier = id(self)
 
+        # the cached results of possible_definition() and
+        # fully_expand_representations() (None if not computed)
+        self._possible_definition = None
+        self._expanded_representations = None
+        self._human_friendly_representations = None
+        self._leaves_human_reps = None
+        self._subtree_concepts = None
+        self._subtree_rep_index = None
+
         # ensure we have a lsit of representations
         if self.representations is None:
             self.representations = []
 
-        # always add the basic default rep
-        srep = "#|id={0}|#".format(
-            self.identifier )
-        self.representations.append( Representation(
-            srep,
+        # always add the basic default rep.
+        # These are rarely looked at so only format them when needed.
+        # The format strings are shared by all concepts of a type
+        id_args = ( self.identifier, )
+        self.representations.append( LazyRepresentation(
+            _ID_REP_FORMAT,
+            id_args,
             level=Representation.LEVEL_IDENTIFIER) )
-        srep = "#|{1} id={0}|#".format(
-            self.identifier,
-            type(self).__name__)
-        self.representations.append( Representation(
-            srep,
+        self.representations.append( LazyRepresentation(
+            _typed_id_rep_format( type(self) ),
+            id_args,
             level=Representation.LEVEL_IDENTIFIER) )
 
-        # add ourselves to parent if not alreayd there
-        if parent_concept is not None and self not in parent_concept.constituent_concepts:
+        # add ourselves to parent.
+        # We are a brand new concept so we can never already be one of
+        # the parent's constituents, no need to scan for ourselves
+        if parent_concept is not None:
             parent_concept.constituent_concepts.append( self )
+            parent_concept._invalidate_caches()
         
 
     ##
@@ -571,6 +831,20 @@ class ConceptBase( object ):
     def preferred_representation(self):
         return self.representations[0]
 
+    ##
+    # Returns the set of the human_friendly() strings of all of
+    # the representations of this concept.
+    #
+    # This is cached until the constituents change (which can change
+    # the representation of things like commands)
+    def human_friendly_representations(self):
+        strings = self._human_friendly_representations
+        if strings is None:
+            strings = frozenset([ r.human_friendly()
+                                  for r in self.representations ])
+            self._human_friendly_representations = strings
+        return strings
+
     ##
     # By default a stirng representation jsut uses the
     # first representations human_friendly
@@ -586,6 +860,43 @@ class ConceptBase( object ):
             self.identifier,
             leaves )
 
+    ##
+    # Returns this concept and all of it's constituents (recursively)
+    # in pre-order.
+    #
+    # The result is cached until the structure changes, so it is shared
+    # and must not be modified by callers
+    def subtree_concepts(self):
+        res = self._subtree_concepts
+        if res is None:
+            res = []
+            stack = [ self ]
+            while len(stack) > 0:
+                c = stack.pop()
+                res.append( c )
+                stack.extend( reversed( c.constituent_concepts ) )
+            self._subtree_concepts = res
+        return res
+
+    ##
+    # Returns an index of subtree_concepts() by what any_rep_match(...)
+    # can match each concept with: every human_friendly string of a
+    # concept, and it's number of constituents (which a structure
+    # must have), maps to the positions in subtree_concepts() of the
+    # concepts with it.  See rep_match_candidates(...)
+    #
+    # The index is cached along with subtree_concepts()
+    def subtree_rep_index(self):
+        index = self._subtree_rep_index
+        if index is None:
+            index = {}
+            for i, c in enumerate( self.subtree_concepts() ):
+                for s in c.human_friendly_representations():
+                    index.setdefault( s, [] ).append( i )
+                index.setdefault( len( c.constituent_concepts ), [] ).append( i )
+            self._subtree_rep_index = index
+        return index
+
     ##
     # Return true if this is a top-level concept
     def is_toplevel(self):
@@ -595,10 +906,16 @@ class ConceptBase( object ):
     # Removes this concept from the concept graph
     # by removing itself from it's parent constituents list
     # and by setting it's parent ot None
+    #
+    # Note: we just try to remove ourselves (a single scan) rather than
+    #       check for membership first and then remove (two scans)
     def unlink( self ):
         if self.parent_concept is not None:
-            if self in self.parent_concept.constituent_concepts:
+            try:
                 self.parent_concept.constituent_concepts.remove( self )
+            except ValueError:
+                pass
+            self.parent_concept._invalidate_caches()
         self.parent_concept = None
     
     ##
@@ -623,23 +940,78 @@ class ConceptBase( object ):
     #   1) If this Concept has the binding, then it shadows everything and
     #      is the only binding returned
     #   2) Otherwise, all bindings on the constituents are returned :)
+    #
+    # The path is a tuple of the Concepts walked to get to the binding.
+    #
+    # This walks the constituents with an explicit stack (in order)
+    # rather than recursing
     def lookup_bindings( self,
                          identifier,
-                         path = []):
+                         path = ()):
 
-        # Ok, the first check is in our direct context
-        if identifier in self.context:
-            
-            # this context shadows everything, return jsut this binding
-            return [ Binding( path = path + [self],
-                              identifier=identifier,
-                              value=self.context[ identifier ] ) ]
-
-        # Ok, look at all constituents and grab their bindings
         bindings = []
-        for c in self.constituent_concepts:
-            binds = c.lookup_bindings( identifier, path + [self] )
-            bindings.extend( binds )
+        stack = [ ( self, path ) ]
+        while len(stack) > 0:
+            c, path = stack.pop()
+
+            # Ok, the first check is in the direct context
+            context = c.context
+            if identifier in context:
+
+                # this context shadows everything below it, so
+                # this is the only binding from here
+                bindings.append( Binding( path = path + (c,),
+                                          identifier=identifier,
+                                          value=context[ identifier ] ) )
+                continue
+
+            # Ok, look at all constituents and grab their bindings.
+            # They all share the same path to here
+            constituents = c.constituent_concepts
+            if len(constituents) > 0:
+                child_path = path + (c,)
+                for c0 in reversed( constituents ):
+                    stack.append( ( c0, child_path ) )
+        return bindings
+
+    ##
+    # Looks up the bindings for several identifiers at once, with
+    # a single walk of the constituents.
+    #
+    # Returns a dictionary from each identifier to the List[ Binding ]
+    # that lookup_bindings(...) would return for it.  Shadowing is per
+    # identifier, so the walk only goes below a Concept for the
+    # identifiers it does not bind
+    def lookup_bindings_many( self,
+                              identifiers,
+                              path = () ):
+
+        bindings = dict( ( i, [] ) for i in identifiers )
+        stack = [ ( self, path, tuple( bindings ) ) ]
+        while len(stack) > 0:
+            c, path, wanted = stack.pop()
+
+            # grab the bindings in the direct context, the rest
+            # of the identifiers are looked for in the constituents
+            context = c.context
+            remaining = []
+            for identifier in wanted:
+                if identifier in context:
+                    bindings[ identifier ].append(
+                        Binding( path = path + (c,),
+                                 identifier=identifier,
+                                 value=context[ identifier ] ) )
+                else:
+                    remaining.append( identifier )
+            if len(remaining) == 0:
+                continue
+
+            constituents = c.constituent_concepts
+            if len(constituents) > 0:
+                child_path = path + (c,)
+                remaining = tuple( remaining )
+                for c0 in reversed( constituents ):
+                    stack.append( ( c0, child_path, remaining ) )
         return bindings
 
 
@@ -648,6 +1020,13 @@ class ConceptBase( object ):
     # Effecively sets the value at identifier in the Context
     def bind( self, identifier, value ):
         self.context[ identifier ] = value
+        self._invalidate_possible_definition()
+
+    ##
+    # Binds the definition of this Concept
+    def bind_definition( self, definition ):
+        self.context.bind_definition( definition )
+        self._invalidate_possible_definition()
 
     ##
     # We can ask for the "Definition" of this Concept.
@@ -656,28 +1035,83 @@ class ConceptBase( object ):
     #      it
     #   2) If *all* constituents have a definition then we return
     #      the list of all such definitions as a Definition
+    #
+    # The result is cached until this Concept or any of its
+    # constituents change (bindings or structure)
     def possible_definition(self):
+        if self._possible_definition is None:
+            self._possible_definition = self._compute_possible_definition()
+        return self._possible_definition
 
-        # check this context for a definition
-        direct_def = self.context.definition_binding()
-        if direct_def is not None:
-            return direct_def
+    ##
+    # Computes the possible_definition() of this Concept, filling in
+    # the cache of every constituent along the way.
+    #
+    # This is done iteratively in post-order (two passes) so that deep
+    # concept trees do not run into python's recursion limit:
+    #   1) walk down in pre-order collecting every concept whose
+    #      definition is not yet known, stopping at concepts which
+    #      are cached or have a direct definition in their Context
+    #   2) walk the collected concepts in reverse (so constituents
+    #      come before their parents) and assemble their definitions
+    def _compute_possible_definition(self):
+
+        # first pass: pre-order, resolving the cheap cases right away
+        pending = []
+        stack = [ self ]
+        while stack:
+            c = stack.pop()
+            if c._possible_definition is not None:
+                continue
+
+            # check this context for a definition
+            direct_def = c.context.definition_binding()
+            if direct_def is not None:
+                c._possible_definition = direct_def
+                continue
+
+            # if we have no constituents, return base definition
+            if len(c.constituent_concepts) == 0:
+                c._possible_definition = DefinitionBase(
+                    concept = c,
+                    source = None )
+                continue
+
+            pending.append( c )
+            stack.extend( c.constituent_concepts )
+
+        # second pass: all constituents have possible definitions by the
+        # time we reach their parent so return a group definition
+        # with them
+        for c in reversed( pending ):
+            defs = [ x._possible_definition for x in c.constituent_concepts ]
+            c._possible_definition = c._group_possible_definition(defs)
+
+        return self._possible_definition
 
-        # if we have no constituents, return base definition
-        if len(self.constituent_concepts) == 0:
-            return DefinitionBase(
-                concept = self,
-                source = None )
+    ##
+    # Clears the cached possible_definition() of this Concept and
+    # of all of its parents, since theirs depend on ours
+    def _invalidate_possible_definition(self):
+        c = self
+        while c is not None:
+            c._possible_definition = None
+            c = c.parent_concept
 
-        # Ok, now try to get definitions from all constituents
-        defs = []
-        for c in self.constituent_concepts:
-            cdef = c.possible_definition()
-            defs.append( cdef )
-            
-        # ok, all constituents have possible definitions so return a group
-        # definitionf with them
-        return self._group_possible_definition(defs)
+    ##
+    # Clears all cached results which depend on the structure of this
+    # Concept (it's constituents), for it and all of its parents.
+    # Call this whenever the constituents change
+    def _invalidate_caches(self):
+        c = self
+        while c is not None:
+            c._possible_definition = None
+            c._expanded_representations = None
+            c._human_friendly_representations = None
+            c._leaves_human_reps = None
+            c._subtree_concepts = None
+            c._subtree_rep_index = None
+            c = c.parent_concept
 
     ##
     # Retruns a Definition subclass representing the definition from
@@ -694,7 +1128,9 @@ class ConceptBase( object ):
 
 ## 
 # A Binding consists of a path of Concepts, an identifier, and a value.
+# The path is a tuple of Concepts ending in the one with the binding
 class Binding( object ):
+    __slots__ = ( 'path', 'identifier', 'value' )
     def __init__( self,
                   path,
                   identifier,
@@ -770,6 +1206,8 @@ class GroupPossibleDefinition( DefinitionBase ):
 # a definition from being "well-defined"
 class NotWellDefined( object ):
 
+    __slots__ = ( 'definition', )
+
     ##
     # Every NotWellDefined is tried to a DefinitionBase definition
     def __init__( self,
@@ -790,6 +1228,8 @@ class NotWellDefined( object ):
 # well defined
 class NotWellDefinedConcept( NotWellDefined ):
 
+    __slots__ = ( 'concept', )
+
     ##
     # Creates a NotWellDefined with given definition and concept
     # that is not defined
@@ -804,8 +1244,8 @@ class NotWellDefinedConcept( NotWellDefined ):
     # Returns a string representations
     def __str__( self ):
         return "NotWellDefined[Concept: {0}]".format(
-            map(lambda r: r.human_friendly(),
-                self.concept.representations ) )
+            [ r.human_friendly()
+              for r in self.concept.representations ] )
 
 ##=========================================================================
 
@@ -813,6 +1253,8 @@ class NotWellDefinedConcept( NotWellDefined ):
 # A NotWellDefined where a Binding is not defined ut expected
 class NotWellDefinedMissingBinding( NotWellDefined ):
 
+    __slots__ = ( 'binding_name', )
+
     ##
     # Create a new NotWellDefined for given definition and
     # expected binding name
@@ -835,6 +1277,8 @@ class NotWellDefinedMissingBinding( NotWellDefined ):
 # and we expect only one
 class NotWellDefinedAmbiguousBinding( NotWellDefined ):
 
+    __slots__ = ( 'binding_name', 'bindings' )
+
     ##
     # Create a new NotWellDefined with the definition,
     # and binding name, and the bindings for it which are
@@ -865,6 +1309,8 @@ class NotWellDefinedAmbiguousBinding( NotWellDefined ):
 # the definition
 class NotWellDefinedSyntaxError( NotWellDefined ):
 
+    __slots__ = ()
+
     ##
     # Creates a NotWellDefined with the definition which has broken syntax
     def __init__(self,
@@ -880,6 +1326,8 @@ class NotWellDefinedSyntaxError( NotWellDefined ):
 # functions that just reutrn BoxConcept with the input :)
 class ParselessConcept( ConceptBase ):
 
+    __slots__ = ()
+
     def __init__( self, *args, **kw ):
         ConceptBase.__init__( self, *args, **kw )
 
@@ -894,6 +1342,8 @@ class ParselessConcept( ConceptBase ):
 # This is just an opaque value
 class BoxConcept( ParselessConcept ):
 
+    __slots__ = ( 'value', )
+
     def __init__( self,
                   parent_concept,
                   value ):
@@ -924,6 +1374,8 @@ class BoxConcept( ParselessConcept ):
 #
 class CommandConcept( ParselessConcept ):
 
+    __slots__ = ( 'command_identifier', )
+
     ##
     # Initialize with command name and arguments
     # along with a parent concept
@@ -948,12 +1400,7 @@ class CommandConcept( ParselessConcept ):
 
         # a default representation with the command name and args
         reps = []
-        reps.append( Representation(
-            "{0}( {1} )".format(
-                command_identifier,
-                map(lambda c: c.preferred_representation().human_friendly(),
-                    arg_concepts) ),
-            level = Representation.LEVEL_HUMAN_SEMMANTICS ) )
+        reps.append( CommandRepresentation( self ) )
 
         # ok, create baseclass
         ConceptBase.__init__(
@@ -16,7 +16,6 @@ logger = logging.getLogger( __name__ )
 #      to keep a set of seen concepts
 #   4) A way to interact with the user with prompts
 
-import copy
 
 import concept
 import basic_grammar_concept
@@ -33,27 +32,37 @@ import basic_grammar_concept
 #    3) A list of prompts (InterpreterBase instances :) )
 class InterpreterBase( object ):
 
+    __slots__ = ( 'state', )
+
     ##
     # The State class for this interpreter
     class State( object ):
 
+        __slots__ = ( 'current_concept',
+                      'top_level_concepts',
+                      'prompts' )
+
         ##
         # Creates a new state with given current concept,
         # given top-level concepts and prompt
         def __init__( self,
                       current_concept = None,
-                      top_level_concepts = [],
-                      prompts = [] ):
+                      top_level_concepts = None,
+                      prompts = None ):
             self.current_concept = current_concept
             self.top_level_concepts = top_level_concepts
+            if self.top_level_concepts is None:
+                self.top_level_concepts = []
             self.prompts = prompts
+            if self.prompts is None:
+                self.prompts = []
 
         ##
         # Shallow copy of state
         def shallow_copy(self):
-            return State( self.current_concept,
-                          copy.copy( self.top_level_concepts ),
-                          copy.copy( self.prompts ) ) 
+            return type(self)( self.current_concept,
+                               list( self.top_level_concepts ),
+                               list( self.prompts ) )
 
         ##
         # Creates a new initial state
@@ -70,9 +79,11 @@ class InterpreterBase( object ):
 
     ##
     # Creates a new Interpreter with given initial prompt and
-    # state
+    # state (a new initial state if not given)
     def __init__( self,
-                  init_state = State.initial_state() ):
+                  init_state = None ):
+        if init_state is None:
+            init_state = InterpreterBase.State.initial_state()
         self.state = init_state
 
     ##
@@ -94,13 +105,12 @@ class InterpreterBase( object ):
 
     ##
     # Removes any prompts from the state which are done
+    #
+    # This is a single pass, and the prompts list is updated in place
+    # since others may hold on to it
     def remove_done_prompts(self):
-        to_remove = []
-        for i, p in enumerate( self.state.prompts ):
-            if p.is_done():
-                to_remove.append( i )
-        for i in reversed(to_remove):
-            del self.state.prompts[i]
+        prompts = self.state.prompts
+        prompts[:] = [ p for p in prompts if not p.is_done() ]
             
 
     ##
@@ -109,14 +119,10 @@ class InterpreterBase( object ):
 
         # Ok, grab the current concept from state and use it
         # to parse the raw input
-        logger.info( "[{name}] going to parse '{0}'".format(
-            raw,
-            name = id(self) ) )
+        logger.info( "[%s] going to parse '%s'", id(self), raw )
         c = state.current_concept
         parsed_concepts = c.parse( raw )
-        logger.info( "[{name}] parsed #{0} concepts".format(
-            len(parsed_concepts),
-            name = id(self) ) )
+        logger.info( "[%s] parsed #%s concepts", id(self), len(parsed_concepts) )
 
 
         # Ok, now interpret each concept in turn
@@ -139,9 +145,9 @@ class InterpreterBase( object ):
         c.unlink()
 
         # Ok, dispatch based on the command here for subclasses
-        method_name = "_command_{0}".format( c.command_identifier )
-        if hasattr( self, method_name ):
-            getattr( self, method_name )( c, state )
+        handler = _command_handlers( type(self) ).get( c.command_identifier, None )
+        if handler is not None:
+            handler( self, c, state )
         else:
 
             # ok, we do not have a method for this command
@@ -169,44 +175,56 @@ class InterpreterBase( object ):
     #    2) If the structures are the same, then look for the same
     #       representation-as-a-string equality
     #
-    # Returns all matching concepts
-    def _resolve_concept_reference( self, c, state ):
-
-        logger.info( "[{name}]: Starting _resolve_concept_reference for concept '{0}'".format(
-            c.debug_string(),
-            name = id(self) ) )
+    # Returns all matching concepts, or just the first limit of them
+    # if a limit is given (callers that only need to tell no/one/many
+    # matches apart can use a limit of 2 to stop looking early)
+    def _resolve_concept_reference( self, c, state, limit = None ):
+
+        # debug strings walk the whole concept, only build them if logged
+        log_info = logger.isEnabledFor( logging.INFO )
+        if log_info:
+            logger.info( "[{name}]: Starting _resolve_concept_reference for concept '{0}'".format(
+                c.debug_string(),
+                name = id(self) ) )
 
         # Ok, grab teh fully expanded forms of representations for
         # this concept
         c_fully_expanded_reps = concept.fully_expand_representations( c )
-        logger.info( "[{name}]:   fully expanded to: {0}".format(
-            c_fully_expanded_reps,
-            name=id(self) ) )
+        if log_info:
+            logger.info( "[{name}]:   fully expanded to: {0}".format(
+                c_fully_expanded_reps,
+                name=id(self) ) )
 
-        # now, for each known concept, check if there is a match
+        # now, for each known concept which might match, check if
+        # there is a match
         matching_concepts = []
-        for c0 in self._all_concepts( state ):
+        for c0 in self._rep_match_candidates( c_fully_expanded_reps, state ):
 
             # no self references
             if c0 is c:
                 continue
 
-            logger.info( "[{name}]: checking match with {0}".format(
-                c0.debug_string(),
-                name=id(self) ) )
+            if log_info:
+                logger.info( "[{name}]: checking match with {0}".format(
+                    c0.debug_string(),
+                    name=id(self) ) )
 
             # chekc if match
             if concept.any_rep_match( c_fully_expanded_reps,
                                       c0 ):
-                logger.info( "[{name}]: match found!".format(
-                    name=id(self) ) )
+                if log_info:
+                    logger.info( "[{name}]: match found!".format(
+                        name=id(self) ) )
                 matching_concepts.append( c0 )
+                if limit is not None and len(matching_concepts) >= limit:
+                    break
 
         # log some things
-        logger.info( "[{name}]: resolved #{0} refs for '{1}'".format(
-            len(matching_concepts),
-            c.preferred_representation().human_friendly(),
-            name=id(self) ) )
+        if log_info:
+            logger.info( "[{name}]: resolved #{0} refs for '{1}'".format(
+                len(matching_concepts),
+                c.preferred_representation().human_friendly(),
+                name=id(self) ) )
         
         # return all the matches found
         return matching_concepts
@@ -225,16 +243,20 @@ class InterpreterBase( object ):
     # occurs
     def _resolve_concept_substructure_reference( self, c, state ):
 
-        logger.info( "[{name}]: Starting _resolve_concept_substructure_reference for concept '{0}'".format(
-            c.debug_string(),
-            name = id(self) ) )
+        # debug strings walk the whole concept, only build them if logged
+        log_info = logger.isEnabledFor( logging.INFO )
+        if log_info:
+            logger.info( "[{name}]: Starting _resolve_concept_substructure_reference for concept '{0}'".format(
+                c.debug_string(),
+                name = id(self) ) )
 
         # Ok, grab teh fully expanded forms of representations for
         # this concept
         c_fully_expanded_reps = concept.fully_expand_representations( c )
-        logger.info( "[{name}]:   fully expanded to: {0}".format(
-            c_fully_expanded_reps,
-            name=id(self) ) )
+        if log_info:
+            logger.info( "[{name}]:   fully expanded to: {0}".format(
+                c_fully_expanded_reps,
+                name=id(self) ) )
 
         # now, for each known concept, check if there is a match
         matching_concepts = []
@@ -244,24 +266,27 @@ class InterpreterBase( object ):
             if c0 is c:
                 continue
 
-            logger.info( "[{name}]: checking match with {0}".format(
-                c0.debug_string(),
-                name=id(self) ) )
+            if log_info:
+                logger.info( "[{name}]: checking match with {0}".format(
+                    c0.debug_string(),
+                    name=id(self) ) )
 
             # chekc if match
             m = concept.any_rep_substructure_matches( c_fully_expanded_reps,
                                                       c0 )
             if m is not None and len(m) > 0:
-                logger.info( "[{name}]: #{0} matches found!".format(
-                    len(m),
-                    name=id(self) ) )
+                if log_info:
+                    logger.info( "[{name}]: #{0} matches found!".format(
+                        len(m),
+                        name=id(self) ) )
                 matching_concepts.append( m )
 
         # log some things
-        logger.info( "[{name}]: resolved #{0} refs for '{1}'".format(
-            len(matching_concepts),
-            c.preferred_representation().human_friendly(),
-            name=id(self) ) )
+        if log_info:
+            logger.info( "[{name}]: resolved #{0} refs for '{1}'".format(
+                len(matching_concepts),
+                c.preferred_representation().human_friendly(),
+                name=id(self) ) )
         
         # return all the matches found
         return matching_concepts
@@ -271,21 +296,51 @@ class InterpreterBase( object ):
     # retunrs all of the concepts in the given state.
     # This will be a flattented list of all the concept including
     # intermediate concepts which have children
+    #
+    # The concepts are in pre-order, each at most once.  The concepts
+    # under each top-level concept are cached on it (see
+    # ConceptBase.subtree_concepts() ) until it's structure changes, so
+    # the result must not be modified
     def _all_concepts( self, state ):
 
-        def _dfs( c, q ):
-            res = []
-            if c not in q:
+        # the common case: a single top-level concept
+        top_level_concepts = state.top_level_concepts
+        if len(top_level_concepts) == 1:
+            return top_level_concepts[0].subtree_concepts()
+
+        seen = set([])
+        res = []
+        for top in top_level_concepts:
+            for c in top.subtree_concepts():
+                k = id(c)
+                if k in seen:
+                    continue
+                seen.add( k )
                 res.append( c )
-                q.add( c ) 
-                for c0 in c.constituent_concepts:
-                    res.extend( _dfs( c0, q ) )
-            return res
+        return res
 
-        q = set([])
+
+    ##
+    # returns the concepts in the given state which may match the
+    # given fully expanded reps (see concept.rep_match_candidates(...) ),
+    # in the same order as _all_concepts(...)
+    def _rep_match_candidates( self, expanded_reps, state ):
+
+        # the common case: a single top-level concept
+        top_level_concepts = state.top_level_concepts
+        if len(top_level_concepts) == 1:
+            return concept.rep_match_candidates( expanded_reps,
+                                                 top_level_concepts[0] )
+
+        seen = set([])
         res = []
-        for c in state.top_level_concepts:
-            res.extend( _dfs( c, q ) )
+        for top in top_level_concepts:
+            for c in concept.rep_match_candidates( expanded_reps, top ):
+                k = id(c)
+                if k in seen:
+                    continue
+                seen.add( k )
+                res.append( c )
         return res
 
 
@@ -325,8 +380,8 @@ class InterpreterBase( object ):
 
         # ok, check whether we even have to split a concept or jsut
         # add a parent layer
-        if all(map(lambda r: r == SubstructureMatch.WHOLE_CONCEPT),
-               subm.constituent_ranges ):
+        if all( r == SubstructureMatch.WHOLE_CONCEPT
+                for r in subm.constituent_ranges ):
 
             # we jsut need to add a parent.
             # what a nice case we have here :) ... or not heheheh
@@ -334,16 +389,11 @@ class InterpreterBase( object ):
             # ok, so we need to first find the latest common ancestor
             # for each of the wholly used nodes
             # Note: tehre is always a root so we always have one ancestor :)
-            ancestors = map(lambda c: concept.ancestors(c),
-                            subm.concepts)
-            longest_common_ancestors = longest_common_prefix( ancestors )
-            ancestral_parent = longest_common_ancestors[-1]
+            ancestral_parent = concept.lowest_common_ancestor( subm.concepts )
 
             # ok, now we need to choose the constituents of the *ancestor* as
             # the constituents of hte new concept
             ancestral_constituents = []
-            for ancs in ancestors:
-                pass 
             parent_c = basic_grammar_concept.BasicGrammarConcept(
                 parent_concept = 
 
@@ -355,8 +405,7 @@ class InterpreterBase( object ):
     # in the state
     def _command_enter_concept( self, cmd, state ):
 
-        logger.info( "[{name}]: COMMAND[enter_concept] started".format(
-            name=id(self) ) )
+        logger.info( "[%s]: COMMAND[enter_concept] started", id(self) )
 
         # ok, look for concept reference in the args
         arg_c = cmd.constituent_concepts[0]
@@ -364,7 +413,8 @@ class InterpreterBase( object ):
             arg_c = arg_c.constituent_concepts[0]
         concept_refs = self._resolve_concept_reference(
             arg_c,
-            state )
+            state,
+            limit = 2 )
 
         # show message if no concept reference found or too many
         if len(concept_refs) == 0:
@@ -375,15 +425,13 @@ class InterpreterBase( object ):
         elif len(concept_refs) > 1:
             state.prompts.append(
                 MessagePrompt(
-                    "Concept to enter is Ambiguous found #{0} matches".format(
-                        len(concept_refs) ),
+                    "Concept to enter is Ambiguous found multiple matches",
                     self ) )
         else:
 
             # ok, found a single match, change the current concept to it
             state.current_concept = concept_refs[0]
-            logger.info( "Changing current_concept to '{0}'".format(
-                state.current_concept.preferred_representation().human_friendly()) )
+            logger.info( "Changing current_concept to '%s'", state.current_concept )
 
 
     ##
@@ -400,8 +448,7 @@ class InterpreterBase( object ):
     # that it can be "lifted" with no problems
     def _command_enter_partial( self, cmd, state ):
 
-        logger.info( "[{name}]: COMMAND[enter_concept] started".format(
-            name=id(self) ) )
+        logger.info( "[%s]: COMMAND[enter_concept] started", id(self) )
 
         # ok, look for concept reference in the args
         arg_c = cmd.constituent_concepts[0]
@@ -433,8 +480,7 @@ class InterpreterBase( object ):
             if self._substructure_match_is_whole( matches[0] ):
                 
                 state.current_concept = matches[0].concepts[0]
-                logger.info( "Changing current_concept to '{0}'".format(
-                    state.current_concept.preferred_representation().human_friendly()) )
+                logger.info( "Changing current_concept to '%s'", state.current_concept )
 
             # ok, now check if it is a liftable substructure
             elif self._is_liftable_substructure_match( matches[0] ):
@@ -443,8 +489,7 @@ class InterpreterBase( object ):
                 # as current conceopt
                 newc = self._lift_substructure_match( matches[0] )
                 state.current_concept = newc
-                logger.info( "Changing current_concept to '{0}'".format(
-                    state.current_concept.preferred_representation().human_friendly()) )
+                logger.info( "Changing current_concept to '%s'", state.current_concept )
 
             else:
 
@@ -464,13 +509,11 @@ class InterpreterBase( object ):
     # current concept
     def _command_leave_concept( self, cmd, state ):
 
-        logger.info( "[{name}]: COMMAND[leave_concept] started".format(
-            name=id(self) ) )
+        logger.info( "[%s]: COMMAND[leave_concept] started", id(self) )
 
         if state.current_concept.parent_concept is not None:
             state.current_concept = state.current_concept.parent_concept
-            logger.info( "Changing current_concept to parent: '{0}'".format(
-                state.current_concept.preferred_representation().human_friendly()) )
+            logger.info( "Changing current_concept to parent: '%s'", state.current_concept )
         else:
 
             # hmm, it's an error to leave but we're going to ignore it :)
@@ -480,8 +523,7 @@ class InterpreterBase( object ):
     # Perofmrs a binding in hte current concept's context
     def _command_bind( self, cmd, state ):
 
-        logger.info( "[{name}]: COMMAND[bind] started".format(
-            name=id(self) ) )
+        logger.info( "[%s]: COMMAND[bind] started", id(self) )
 
         # make sure we have exactly two args
         if len(cmd.constituent_concepts[0].constituent_concepts) != 2:
@@ -492,35 +534,37 @@ class InterpreterBase( object ):
         else:
 
             # ok, now we will resolve references
-            symbol_concept = cmg.constituent_concepts[0].constituent_concepts[0]
+            symbol_concept = cmd.constituent_concepts[0].constituent_concepts[0]
             value_concept = cmd.constituent_concepts[0].constituent_concepts[1]
 
             # resolve symbol reference, set ot None if error
             symbol_refs = self._resolve_concept_reference(
                 symbol_concept,
-                state )
+                state,
+                limit = 2 )
             if len(symbol_refs) == 1:
                 symbol_concept = symbol_refs[0]
             elif len(symbol_refs) > 1:
                 state.prompts.append(
                     MessagePrompt(
-                        "Ambiguous concept reference as first argument of bind ocmmand, mathched '{0}' with #{1} matches".format(
-                            symbol_concept.preferred_representation.human_friendly(),
-                            len(symbol_refs) ) ) )
+                        "Ambiguous concept reference as first argument of bind ocmmand, mathched '{0}' with multiple matches".format(
+                            symbol_concept.preferred_representation().human_friendly() ),
+                        self ) )
                 symbol_concept = None
 
             # resolve value concept, set to None if error
             value_refs = self._resolve_concept_reference(
                 value_concept,
-                state )
+                state,
+                limit = 2 )
             if len(value_refs) == 1:
                 value_concept = value_refs[0]
             elif len(value_refs) > 1:
                 state.prompts.append(
                     MessagePrompt(
-                        "Ambiguous concept reference as second argument of bind ocmmand, mathched '{0}' with #{1} matches".format(
-                            value_concept.preferred_representation.human_friendly(),
-                            len(value_refs) ) ) )
+                        "Ambiguous concept reference as second argument of bind ocmmand, mathched '{0}' with multiple matches".format(
+                            value_concept.preferred_representation().human_friendly() ),
+                        self ) )
                 value_concept = None
 
             # perform bind if we had no error
@@ -529,34 +573,85 @@ class InterpreterBase( object ):
                 # ok, grab the preffered representaiton of the symbol to bind to
                 symbol_string = symbol_concept.preferred_representation().human_friendly()
 
-                state.curret_concept.bind( symbol_string,
-                                           value_concept )
-                logger.info( "Created binding '{0}' => {1}".format(
-                    symbol_string,
-                    value_concept.preferred_representation().human_friendly()))
+                state.current_concept.bind( symbol_string,
+                                            value_concept )
+                logger.info( "Created binding '%s' => %s", symbol_string, value_concept )
             
             
+##=========================================================================
+
+##
+# The command handlers of each interpreter class, by class
+_command_handlers_by_class = {}
+
+##
+# Returns a dictionary from command identifier to the handler for it
+# (the _command_<identifier> method) for the given interpreter class.
+# This is built once per class by looking through it's methods
+def _command_handlers( interpreter_class ):
+    handlers = _command_handlers_by_class.get( interpreter_class, None )
+    if handlers is None:
+        prefix = "_command_"
+        handlers = {}
+        for name in dir( interpreter_class ):
+            if name.startswith( prefix ):
+                handlers[ name[ len(prefix): ] ] = getattr( interpreter_class, name )
+        _command_handlers_by_class[ interpreter_class ] = handlers
+    return handlers
+
 ##=========================================================================
 ##=========================================================================
 
 ##
 # A simple prompt which just contains a single message and nothing
 # can be done iwth it
+#
+# Many messages are finished without ever being looked at, so the
+# State (and the BoxConcept holding the message) is only created
+# the first time it is asked for
 class MessagePrompt( InterpreterBase ):
 
+    __slots__ = ( 'message',
+                  'parent_interpreter',
+                  '_parent_concept',
+                  '_state',
+                  '_done' )
+
     ##
     # Just contains a message and  parent interpreter
     def __init__( self,
                   message,
                   parent_interpreter ):
+        self.message = message
         self.parent_interpreter = parent_interpreter
-        c = concept.BoxConcept(
-            parent_concept = parent_interpreter.state.current_concept,
-            value = message )
-        state = InterpreterBase.State(
-            current_concept = c,
-            top_level_concepts = [ c ] )
-        InterpreterBase.__init__( self, state )
+        self._parent_concept = parent_interpreter.state.current_concept
+        self._state = None
+        self._done = False
+
+    ##
+    # The State of this prompt, created when first needed
+    # (None once finished)
+    @property
+    def state(self):
+        if self._state is None and not self._done:
+            c = concept.BoxConcept(
+                parent_concept = self._parent_concept,
+                value = self.message )
+            self._state = InterpreterBase.State(
+                current_concept = c,
+                top_level_concepts = [ c ] )
+        return self._state
+
+    @state.setter
+    def state(self, state):
+        self._state = state
+        self._done = state is None
+
+    ##
+    # A message is "done" once finished, whether or not it's State
+    # was ever created
+    def is_done(self):
+        return self._done
 
         
 
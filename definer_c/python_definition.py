@@ -48,11 +48,13 @@ class PythonDefinition( concept_module.DefinitionBase ):
         # Ok, look for each of hte free variables and
         # see if we have exactly one binding for it.
         # Having too many is not good eaither
+        # (the bindings for all of them are looked up together)
         nwds = []
+        binds_by_name = self.concept.lookup_bindings_many( self.free_vars )
         for v in self.free_vars:
 
             # grab dingins for free variable
-            binds = self.concept.lookup_bindings( v )
+            binds = binds_by_name[ v ]
 
             # Ok, if 0 or more than one we are not well defined :)
             if len(binds) < 1:
@@ -75,42 +77,75 @@ class PythonDefinition( concept_module.DefinitionBase ):
     # that is either a free-variable or a global (not assigned)
     # in the toplevel :)
     #
-    # Returns a list of the names of the free variables
+    # Returns a tuple of the names of the free variables
+    # (None if the source is not valid python)
     def _compute_free_variables(self):
+        return _source_free_variables( self.source )
 
-        # ok, we will try parsing hte source and computing the
-        # symboltable for the source
-        try:
-            st = symtable.symtable(
-                code = self.source,
-                filename = self.concept.representations[0].human_friendly(),
-                compile_type = 'exec' )
+##=========================================================================
+
+##
+# The free variables of the python bodies of ContextSwitch inputs,
+# keyed by the body.  The same body is often entered (or re-parsed)
+# again, so it is only run through symtable once while it is cached.
+#
+# A CLI session may see any number of bodies, so the cache is simply
+# emptied once it holds _SOURCE_FREE_VARIABLES_CACHE_SIZE of them
+_SOURCE_FREE_VARIABLES_CACHE_SIZE = 256
+_source_free_variables_cache = {}
+
+##
+# Returns the (cached) tuple of names of the free variables of the given
+# python source, or None if the source is not valid python
+def _source_free_variables( source ):
+    try:
+        return _source_free_variables_cache[ source ]
+    except KeyError:
+        pass
+
+    # ok, we will try parsing hte source and computing the
+    # symboltable for the source
+    try:
+        st = symtable.symtable(
+            code = source,
+            filename = "<definition>",
+            compile_type = 'exec' )
+
+        # Ok, now that we have the symbol table, find all
+        # variables in toplevel denoted as "free" or "global"
+        fvars = []
+        for s in st.get_symbols():
+            if s.is_free() or s.is_global():
+                fvars.append( s.get_name() )
+        fvars = tuple( fvars )
 
-            # Ok, now that we have the symbol table, find all
-            # variables in toplevel denoted as "free" or "global"
-            fvars = []
-            for s in st.get_symbols():
-                if s.is_free() or s.is_global():
-                    fvars.append( s.get_name() )
+    except ( SyntaxError, TypeError, ValueError ):
+        fvars = None
 
-            # return the found free varibles
-            return fvars
-            
-        except:
-            return None
+    if len(_source_free_variables_cache) >= _SOURCE_FREE_VARIABLES_CACHE_SIZE:
+        _source_free_variables_cache.clear()
+    _source_free_variables_cache[ source ] = fvars
+    return fvars
 
 ##=========================================================================
 ##=========================================================================
 
+##
+# The properties of a symtable.Symbol shown by describe_symbol(...),
+# with the (unbound) Symbol method checking each
+_SYMBOL_PROPS = tuple(
+    ( prop, getattr( symtable.Symbol, 'is_' + prop ) )
+    for prop in [
+            'referenced', 'imported', 'parameter',
+            'global', 'declared_global', 'local',
+            'free', 'assigned', 'namespace'] )
+
 def describe_symbol(sym):
     assert type(sym) == symtable.Symbol
     print "Symbol:", sym.get_name()
 
-    for prop in [
-            'referenced', 'imported', 'parameter',
-            'global', 'declared_global', 'local',
-            'free', 'assigned', 'namespace']:
-        if getattr(sym, 'is_' + prop)():
+    for prop, is_prop in _SYMBOL_PROPS:
+        if is_prop( sym ):
             print '    is', prop
 
 ##=========================================================================
@@ -184,6 +184,52 @@ class NotWellDefinedSyntaxError( NotWellDefined ):
 ##========================================================================
 ##========================================================================
 
+##
+# The free variables of python sources, keyed by the source.
+# Definitions are often created again and again with the same source
+# so we only parse each source once (while it is cached).
+#
+# The cache is emptied once it holds _SOURCE_FREE_VARIABLES_CACHE_SIZE
+# sources so a long session does not keep every source ever seen
+_SOURCE_FREE_VARIABLES_CACHE_SIZE = 256
+_source_free_variables_cache = {}
+
+##
+# Returns the (cached) tuple of names of the free variables of the given
+# python source, or None if the source is not valid python
+def _source_free_variables( source ):
+    try:
+        return _source_free_variables_cache[ source ]
+    except KeyError:
+        pass
+
+    # ok, we will try parsing hte source and computing the
+    # symboltable for the source
+    try:
+        st = symtable.symtable(
+            code = source,
+            filename = "<definition>",
+            compile_type = 'exec' )
+
+        # Ok, now that we have the symbol table, find all
+        # variables in toplevel denoted as "free" or "global"
+        # (interned, since they are looked up in node contexts)
+        fvars = []
+        for s in st.get_symbols():
+            if s.is_free() or s.is_global():
+                fvars.append( intern( s.get_name() ) )
+        fvars = tuple( fvars )
+
+    except ( SyntaxError, TypeError, ValueError ):
+        fvars = None
+
+    if len(_source_free_variables_cache) >= _SOURCE_FREE_VARIABLES_CACHE_SIZE:
+        _source_free_variables_cache.clear()
+    _source_free_variables_cache[ source ] = fvars
+    return fvars
+
+##========================================================================
+
 
 ##
 # A Definition that assumes the source is python source code
@@ -245,30 +291,10 @@ class PythonDefinition( DefinitionBase ):
     # that is either a free-variable or a global (not assigned)
     # in the toplevel :)
     #
-    # Returns a list of the names of the free variables
+    # Returns a tuple of the names of the free variables
+    # (None if the source is not valid python)
     def _compute_free_variables(self):
-
-        # ok, we will try parsing hte source and computing the
-        # symboltable for the source
-        try:
-            st = symtable.symtable(
-                code = self.source,
-                filename = self.node.human_friendly(),
-                compile_type = 'exec' )
-
-            # Ok, now that we have the symbol table, find all
-            # variables in toplevel denoted as "free" or "global"
-            fvars = []
-            for s in st.get_symbols():
-                if s.is_free() or s.is_global():
-                    fvars.append( s.get_name() )
-
-            # return the found free varibles
-            return fvars
-            
-        except:
-            return None
-
+        return _source_free_variables( self.source )
 
 
 ##========================================================================
@@ -17,27 +17,40 @@ import collections
 ##========================================================================
 
 ##
-# A Context is a glorified dictionary with utility functions and a type tag
-class Context( dict ):
+# A Context is a plain dictionary from identifier to bound value.
+#
+# There is a *special* identifier for a "definition" of something,
+# which the free functions below access (a bare dict rather than a dict
+# subclass keeps dict's own fast lookups for every binding lookup)
+DEFINITION_KEY = intern( "%%DEFINITION%%" )
 
-    DEFINITION_KEY = "%%DEFINITION%%"
+##
+# Returns the definition bound in the given context (or None)
+def definition_binding( context ):
+    return context.get( DEFINITION_KEY, None )
 
-    ##
-    # Initialize the dictionary
-    def __init__( self, *args, **kw ):
-        dict.__init__( self, *args, **kw )
+##
+# bind the definition in the given context
+def bind_definition( context, definition ):
+    context[ DEFINITION_KEY ] = definition
 
-    ##
-    # There is a *special* identifier for a "definition" of something,
-    # and here we can access it
-    def definition_binding(self):
-        return self.get( self.DEFINITION_KEY, None )
 
-    ##
-    # bind the definition in this context
-    def bind_definition(self,definition):
-        self[ self.DEFINITION_KEY ] = definition
+##========================================================================
 
+##
+# Marker for an identifier with no binding in a Context (since None
+# may itself be bound)
+_UNBOUND = object()
+
+##
+# Returns the interned version of a (byte) string identifier so that
+# Context lookups with it compare keys by identity.
+# Other identifiers (including unicode, which can not be interned)
+# are returned as is
+def _intern_identifier( identifier ):
+    if type(identifier) is str:
+        return intern( identifier )
+    return identifier
 
 ##========================================================================
 ##========================================================================
@@ -56,11 +69,45 @@ class Context( dict ):
 #              'parental_representaiton'
 class NodePath( object ):
 
+    __slots__ = ( 'head', 'tail', '_len', '_hash' )
+
     ##
-    # A step class. All subclasses conform to this
-    Step = collections.namedtuple( 'Step',
-                                   [ 'direction',
-                                     'node' ] )
+    # A step class. All subclasses conform to this.
+    #
+    # Steps are created for every step of every graph walk so they are
+    # small __slots__ objects (rather than namedtuples), with the
+    # direction kind of each subclass fixed.
+    # The direction is kept flat as its list_id (kind) and node (owner)
+    # so that creating, hashing and comparing a step does not build or
+    # walk a nested direction tuple
+    class Step( object ):
+        __slots__ = ( 'kind', 'owner', 'node' )
+        def __init__( self, direction, node ):
+            if direction is None:
+                self.kind = None
+                self.owner = None
+            else:
+                self.kind, self.owner = direction
+            self.node = node
+        @property
+        def direction( self ):
+            if self.kind is None:
+                return None
+            return ( self.kind, self.owner )
+        def __eq__( self, a ):
+            if not isinstance( a, NodePath.Step ):
+                return False
+            return ( self.kind == a.kind
+                     and self.owner == a.owner
+                     and self.node == a.node )
+        def __ne__( self, a ):
+            return not self.__eq__( a )
+        def __hash__( self ):
+            return hash( ( self.kind, self.owner, self.node ) )
+        def __repr__( self ):
+            return "Step(direction={0!r}, node={1!r})".format(
+                self.direction,
+                self.node )
 
     ##
     # A "Direct" step which has no direction
@@ -68,73 +115,99 @@ class NodePath( object ):
     # Create this step with just the node
     class DirectStep( Step ):
         __slots__ = ()
-        def __new__( cls, node ):
-            self = super( NodePath.DirectStep, cls ).__new__( cls, None, node )
-            return self
+        def __init__( self, node ):
+            self.kind = None
+            self.owner = None
+            self.node = node
 
     ##
     # A step into a "piece" of a node
     class PieceStep( Step ):
         __slots__ = ()
-        def __new__( cls, node, piece ):
-            self = super( NodePath.PieceStep, cls ).__new__(
-                cls,
-                ( 'pieces', node ) ,
-                piece )
-            return self
+        def __init__( self, node, piece ):
+            self.kind = 'pieces'
+            self.owner = node
+            self.node = piece
 
     ##
     # A step into a "representation" of a node
     class RepresentationStep( Step ):
         __slots__ = ()
-        def __new__( cls, node, rep ):
-            self = super( NodePath.RepresentationStep, cls ).__new__(
-                cls,
-                ( 'representations', node ) ,
-                rep )
-            return self
+        def __init__( self, node, rep ):
+            self.kind = 'representations'
+            self.owner = node
+            self.node = rep
 
 
     ##
     # A step into a "parental representation" of a node
     class ParentalRepresentationStep( Step ):
         __slots__ = ()
-        def __new__( cls, node, parental_rep ):
-            self = super( NodePath.ParentalRepresentationStep, cls ).__new__(
-                cls,
-                ( 'is_representation_of', node ) ,
-                parental_rep )
-            return self
+        def __init__( self, node, parental_rep ):
+            self.kind = 'is_representation_of'
+            self.owner = node
+            self.node = parental_rep
 
     ##
     # A step into a "parental piece" of a node
     class ParentalPieceStep( Step ):
         __slots__ = ()
-        def __new__( cls, node, parental_piece ):
-            self = super( NodePath.ParentalPieceStep, cls ).__new__(
-                cls,
-                ( 'is_piece_of', node ) ,
-                parental_piece )
-            return self
+        def __init__( self, node, parental_piece ):
+            self.kind = 'is_piece_of'
+            self.owner = node
+            self.node = parental_piece
+
 
+    ##
+    # Creates an empty node path, or the path of the given tail path
+    # followed by the given head step.
+    #
+    # The path is stored as a linked list from it's last step backwards
+    # so adding a step is constant time and shares the rest of the path
+    # (rather than copying all of the steps every time)
+    def __init__( self, head = None, tail = None ):
+        self.head = head
+        self.tail = tail
+        self._hash = None
+        if head is None:
+            self._len = 0
+        elif tail is None:
+            self._len = 1
+        else:
+            self._len = tail._len + 1
+
+    ##
+    # The steps of the path, in order, as a list
+    @property
+    def steps(self):
+        s = []
+        p = self
+        while p is not None and p.head is not None:
+            s.append( p.head )
+            p = p.tail
+        s.reverse()
+        return s
 
     ##
-    # Creates an empty node path
-    def __init__( self, steps = [] ):
-        self.steps = steps
+    # The number of steps in the path
+    def __len__(self):
+        return self._len
 
     ##
     # Access the start node of the path (if any)
     def start_node(self):
-        if len(self.steps) > 0:
-            return self.steps[0].node
-        return None
+        if self._len == 0:
+            return None
+        p = self
+        while p.tail is not None and p.tail.head is not None:
+            p = p.tail
+        return p.head.node
 
     ##
     # Access the end of the path (if any)
     def end_node(self):
-        if len(self.steps) > 0:
-            return self.steps[-1].node
+        if self._len > 0:
+            return self.head.node
         return None
 
     ##
@@ -142,37 +215,29 @@ class NodePath( object ):
     # without a given direction.  These are usually at the
     # ends of a NodePath representing a goal or  start
     def add_direct_step( self, node ):
-        s = list(self.steps)
-        s.append( NodePath.DirectStep( node ) )
-        return NodePath( s )
+        return NodePath( NodePath.DirectStep( node ), self )
 
     ##
     # Add a new step taken into a piece of a node
     def add_piece_step( self, node, piece ):
-        s = list(self.steps)
-        s.append( NodePath.PieceStep( node, piece ) )
-        return NodePath( s )
+        return NodePath( NodePath.PieceStep( node, piece ), self )
 
     ##
     # Add a new step taken into a representation of a node
     def add_representation_step( self, node, rep ):
-        s = list(self.steps)
-        s.append( NodePath.RepresentationStep( node, rep ) )
-        return NodePath( s )
+        return NodePath( NodePath.RepresentationStep( node, rep ), self )
 
     ##
     # Add a new step taken into a parental representation of node
     def add_parental_representation_step( self, node, parental_rep ):
-        s = list(self.steps)
-        s.append( NodePath.ParentalRepresentationStep( node, parental_rep ) )
-        return NodePath( s )
+        return NodePath( NodePath.ParentalRepresentationStep( node, parental_rep ),
+                         self )
 
     ##
     # Add a new step taken into a parental piece of node
     def add_parental_piece_step( self, node, parental_piece ):
-        s = list(self.steps)
-        s.append( NodePath.ParentalPieceStep( node, parental_piece ) )
-        return NodePath( s )
+        return NodePath( NodePath.ParentalPieceStep( node, parental_piece ),
+                         self )
 
 
     ##
@@ -183,13 +248,33 @@ class NodePath( object ):
         return self.__str__()
 
     ##
-    # Equality and has based on the internal list :)
+    # Equality and has based on the internal tuple :)
+    # (paths are immutable so the hash is only computed once)
     def __eq__( self, a ):
+        if a is self:
+            return True
         if not isinstance(a, NodePath):
             return False
+        if self._len != a._len:
+            return False
         return self.steps == a.steps
+    def __ne__( self, a ):
+        return not self.__eq__( a )
     def __hash__( self ):
-        return hash( tuple(self.steps) )
+        h = self._hash
+        if h is None:
+            h = hash( tuple(self.steps) )
+            self._hash = h
+        return h
+
+##========================================================================
+
+##
+# Returns a new list of the given nodes (or an empty list for None)
+def _node_list( nodes ):
+    if nodes is None:
+        return []
+    return list( nodes )
 
 ##========================================================================
 
@@ -206,23 +291,45 @@ class NodePath( object ):
 # how to lookup bindings within themselves and their parents
 class Node( object ):
 
+    # Nodes are long lived and numerous so they get __slots__ rather
+    # than a __dict__.
+    # The related node lists stay lists since graphs are built up one
+    # add_representation / add_piece at a time
+    __slots__ = ( 'natural_token_structure',
+                  'representations',
+                  'pieces',
+                  'is_representation_of',
+                  'is_piece_of',
+                  '_representation_ids',
+                  '_piece_ids',
+                  '_is_representation_of_ids',
+                  '_is_piece_of_ids',
+                  'context', )
+
     ##
     # Creates a new Node
+    #
+    # Alongside each list of related nodes we keep the set of their ids
+    # so that adding a node does not need to scan the list for it
     def __init__( self,
                   natural_token_structure,
-                  representations = [],
-                  pieces = [],
-                  is_representation_of = [],
-                  is_piece_of = [],
+                  representations = None,
+                  pieces = None,
+                  is_representation_of = None,
+                  is_piece_of = None,
                   context = None ):
         self.natural_token_structure = natural_token_structure
-        self.representations = list(representations)
-        self.pieces = list(pieces)
-        self.is_representation_of = list(is_representation_of)
-        self.is_piece_of = list(is_piece_of)
+        self.representations = _node_list( representations )
+        self.pieces = _node_list( pieces )
+        self.is_representation_of = _node_list( is_representation_of )
+        self.is_piece_of = _node_list( is_piece_of )
+        self._representation_ids = set( map( id, self.representations ) )
+        self._piece_ids = set( map( id, self.pieces ) )
+        self._is_representation_of_ids = set( map( id, self.is_representation_of ) )
+        self._is_piece_of_ids = set( map( id, self.is_piece_of ) )
         self.context = context
         if self.context is None:
-            self.context = Context()
+            self.context = {}
 
     ##
     # returns the id of this node
@@ -235,18 +342,22 @@ class Node( object ):
 
         # ok, add to this node's list (if not already tehre)
         # and also add to the given node's is_representation_of
-        if node not in self.representations:
+        if id(node) not in self._representation_ids:
+            self._representation_ids.add( id(node) )
             self.representations.append( node )
-        if self not in node.is_representation_of:
+        if id(self) not in node._is_representation_of_ids:
+            node._is_representation_of_ids.add( id(self) )
             node.is_representation_of.append( self )
             
 
     ##
     # Add the given node as a piece of this node
     def add_piece( self, node ):
-        if node not in self.pieces:
+        if id(node) not in self._piece_ids:
+            self._piece_ids.add( id(node) )
             self.pieces.append( node )
-        if self not in node.is_piece_of:
+        if id(self) not in node._is_piece_of_ids:
+            node._is_piece_of_ids.add( id(self) )
             node.is_piece_of.append( self )
 
     ##
@@ -255,12 +366,13 @@ class Node( object ):
     def bind( self,
               identifier,
               value ):
+        identifier = _intern_identifier( identifier )
         self.context[ identifier ] = value
 
     ##
     # Binds hte definition for this node
     def bind_definition( self, definition ):
-        self.context.bind_definition( definition )
+        bind_definition( self.context, definition )
 
     ##
     # Lookup any bindings for an identifier
@@ -287,46 +399,98 @@ class Node( object ):
     #
     # The return result is always a list (but may be empty)
     # if Binding objects
+    #
+    # Note: pieces and representations link back to their parents, so the
+    #       node graph has cycles and shared subgraphs.  Each node is only
+    #       searched once per lookup (the first path reaching it wins), so
+    #       the binding paths returned are representative rather than
+    #       every possible path to a binding
+    #
+    # The search is a depth-first walk with an explicit stack of
+    # ( children generator, bindings ) frames, one per node being
+    # searched, rather than recursion.  Each frame collects the
+    # bindings of the node's children, and when it is exhausted it's
+    # bindings are handed up to the frame below it
     def lookup_bindings( self, identifier, path_acum = NodePath() ):
 
+        identifier = _intern_identifier( identifier )
+
+        # keep track of the nodes searched in this lookup
+        visited = set([ id(self) ])
+
         # ok, search for direct binding and return if found
-        if identifier in self.context:
-            return [ Binding(
-                path = path_acum.add_direct_step( self ),
-                identifier = identifier,
-                value = self.context[ identifier ] ) ]
+        direct = self._direct_bindings( identifier, path_acum )
+        if direct is not None:
+            return direct
 
-        # Ok, search the pieces
         bindings = []
+        stack = [ ( self._lookup_children( path_acum, bindings, visited ),
+                    bindings ) ]
+        while len(stack) > 0:
+            children, bindings = stack[-1]
+
+            # search the next child (if any) of the top node
+            for node, path in children:
+                visited.add( id(node) )
+                direct = node._direct_bindings( identifier, path )
+                if direct is not None:
+                    bindings.extend( direct )
+                else:
+                    node_bindings = []
+                    stack.append( ( node._lookup_children( path, node_bindings, visited ),
+                                    node_bindings ) )
+                break
+            else:
+
+                # all children searched, hand bindings to the parent frame
+                stack.pop()
+                if len(stack) > 0:
+                    stack[-1][1].extend( bindings )
+
+        # the last frame popped is our own
+        return bindings
+
+    ##
+    # Returns the (single) direct binding of the identifier in this
+    # node as a list, or None if not directly bound here
+    def _direct_bindings( self, identifier, path_acum ):
+
+        # a single probe of the context
+        value = self.context.get( identifier, _UNBOUND )
+        if value is _UNBOUND:
+            return None
+        return [ Binding(
+            path = path_acum.add_direct_step( self ),
+            identifier = identifier,
+            value = value ) ]
+
+    ##
+    # Generates the ( node, path ) of the nodes to search, in order,
+    # for a lookup_bindings(...) from this node which found no direct
+    # binding, skipping nodes already visited.
+    #
+    # First the pieces are searched. Only if there are no bindings in
+    # the pieces (by the time they have all been searched) do we search
+    # our parental representations *and* out parental pieces
+    def _lookup_children( self, path_acum, bindings, visited ):
         for piece in self.pieces:
-            piece_bindings = piece.lookup_bindings(
-                identifier,
-                path_acum = path_acum.add_piece_step( self, piece ) )
-            bindings.extend( piece_bindings )
+            if id(piece) not in visited:
+                yield piece, path_acum.add_piece_step( self, piece )
 
-        # return these bindings if any found in pieces
+        # return the bindings if any found in pieces
         if len(bindings) > 0:
-            return bindings
+            return
 
-        # Ok, no binding in hte pieces means we search our
-        # parental representations *and* out parental pieces
         for parental_rep in self.is_representation_of:
-            parental_bindings = parental_rep.lookup_bindings(
-                identifier = identifier,
-                path_acum = path_acum.add_parental_representation_step(
+            if id(parental_rep) not in visited:
+                yield parental_rep, path_acum.add_parental_representation_step(
                     self,
-                    parental_rep ) )
-            bindings.extend( parental_bindings )
-        for parental_pieces in self.is_piece_of:
-            parental_bindings = parental_piece.lookup_bindings(
-                identifier = identifier,
-                path_acum = path_acum.add_parental_piece_step(
+                    parental_rep )
+        for parental_piece in self.is_piece_of:
+            if id(parental_piece) not in visited:
+                yield parental_piece, path_acum.add_parental_piece_step(
                     self,
-                    parental_piece ) )
-            bindings.extend( parental_bindings )
-
-        # Ok, return any bindings from parental representations
-        return bindings
+                    parental_piece )
 
 
     ##
@@ -365,28 +529,61 @@ Binding = collections.namedtuple( "Binding",
 # This is just a type-defined List-of-List object
 #
 # TokenStructure objects are *immutable* and functional
+#
+# A structure created by add_token(...) just links the new last token to
+# the structure it was added to (sharing it rather than copying all of
+# the tokens), and the flat tuple of tokens is only built when asked for.
+# Likewise the human-friendly string is only built once, when first
+# asked for
 class TokenStructure( object ):
 
-    __slots__ = ( 'tokens', )
-
-    ##
-    # Creates a new sturcture with given tokens
-    def __init__( self, tokens ):
-        self.tokens = tokens
+    __slots__ = ( '_tokens', 'head', 'tail', '_human_friendly', '_hash' )
+
+    ##
+    # Creates a new sturcture with given tokens, or the structure
+    # of the given tail structure followed by the head token.
+    # The tokens are kept as a tuple
+    def __init__( self, tokens = None, head = None, tail = None ):
+        if tokens is not None:
+            tokens = tuple( tokens )
+        elif tail is None:
+            tokens = ()
+        self._tokens = tokens
+        self.head = head
+        self.tail = tail
+        self._human_friendly = None
+        self._hash = None
+
+    ##
+    # The tokens of this structure as a tuple.
+    # This is built (once) when first asked for
+    @property
+    def tokens(self):
+        t = self._tokens
+        if t is None:
+
+            # walk back to a structure with known tokens
+            added = []
+            ts = self
+            while ts._tokens is None:
+                added.append( ts.head )
+                ts = ts.tail
+            added.reverse()
+            t = ts._tokens + tuple( added )
+            self._tokens = t
+        return t
 
     ##
     # add a token, returning new structure
     # Token should be either a string or a TokenStructure 
     def add_token( self, tok ):
-        t = list(self.tokens)
-        t.append( tok )
-        return TokenStructure( t )
+        return TokenStructure( head = tok, tail = self )
 
     ##
     # A nice representation
     def __str__(self):
         s = "Tokens["
-        s += "{0}".format( self.tokens )
+        s += "{0}".format( list( self.tokens ) )
         s += "]"
         return s
     def __repr__(self):
@@ -395,19 +592,32 @@ class TokenStructure( object ):
     ##
     # A Human-friendly representation
     def human_friendly( self ):
-        s = ' '.join(
-            map(lambda t: "{0}".format(t) if not isinstance(t,TokenStructure) else t.human_friendly(),
-                self.tokens ) )
+        s = self._human_friendly
+        if s is None:
+            s = ' '.join(
+                map(lambda t: "{0}".format(t) if not isinstance(t,TokenStructure) else t.human_friendly(),
+                    self.tokens ) )
+            self._human_friendly = s
         return s
 
     ##
     # Equality and has based on the internal list :)
+    # (structures are immutable so the hash, which hashes all the
+    #  nested structures, is only computed once)
     def __eq__( self, a ):
+        if a is self:
+            return True
         if not isinstance(a, TokenStructure):
             return False
         return self.tokens == a.tokens
+    def __ne__( self, a ):
+        return not self.__eq__( a )
     def __hash__( self ):
-        return hash( tuple(self.tokens) )
+        h = self._hash
+        if h is None:
+            h = hash( self.tokens )
+            self._hash = h
+        return h
 
     
 ##========================================================================
@@ -445,6 +655,28 @@ def test_nodes_0():
     logger.info( "Bindings for 'i': {0}".format( bindings ) )
     return n0
 
+##
+# Bindings written directly into a Node's context (rather than through
+# bind(...)) are found by lookups too
+def test_context_write_lookup():
+
+    # a chain of representations with the binding at the end
+    a = Node( TokenStructure( [ 'a' ] ) )
+    d = Node( TokenStructure( [ 'd' ] ) )
+    a.add_representation( d )
+    d.add_piece( Node( TokenStructure( [ 'p' ] ) ) )
+    assert a.lookup_bindings( 'r' ) == []
+
+    # bind directly through the context
+    d.context[ 'r' ] = 6
+    bindings = d.lookup_bindings( 'r' )
+    assert len(bindings) == 1
+    assert bindings[0].value == 6
+    bindings = d.pieces[0].lookup_bindings( 'r' )
+    assert len(bindings) == 1
+    assert bindings[0].value == 6
+    return bindings
+
 ##========================================================================
 ##========================================================================
 ##========================================================================
@@ -17,6 +17,106 @@ import node_utilities
 import defining
 
 
+##========================================================================
+
+##
+# The kinds of parsed expressions (and references) we dispatch on.
+# These are the names of the grammar rules
+_EXPRESSION_KINDS = frozenset([ 'Statement',
+                                'BindExpression',
+                                'ContextExpression',
+                                'ExplicitNodeReference',
+                                'ImplicitReference' ])
+
+##
+# The types of plain-old-data binding values
+_POD_TYPES = ( str, unicode, bool, int, float )
+
+##
+# The kind of each parsed expression class, by class
+_expression_kinds_by_class = {}
+
+##
+# Returns the kind of a parsed expression (one of _EXPRESSION_KINDS,
+# or 'Command' for any of the command rules) or None if it is not
+# a known kind of expression.
+#
+# textx creates the classes for the grammar rules when the grammar is
+# loaded, so there are no classes to import and check against. Instead
+# the kind is worked out from the class name once per class
+def _expression_kind( expr ):
+    cls = type( expr )
+    try:
+        return _expression_kinds_by_class[ cls ]
+    except KeyError:
+        pass
+    name = cls.__name__
+    if name in _EXPRESSION_KINDS:
+        kind = name
+    elif name.endswith( 'Command' ):
+        kind = 'Command'
+    else:
+        kind = None
+    _expression_kinds_by_class[ cls ] = kind
+    return kind
+
+##========================================================================
+
+##
+# Interns a command name so that lookups of it in the command tables
+# compare by identity. Non-str names (unicode) are returned as is
+def _intern_name( name ):
+    if type(name) is str:
+        return intern( name )
+    return name
+
+##========================================================================
+
+##
+# The parser used by interpreters which are not given one.
+# The grammar is only loaded when this is first needed
+_default_parser = None
+
+##
+# Returns the default parser, creating it if needed
+def default_parser():
+    global _default_parser
+    if _default_parser is None:
+        _default_parser = parsing.Parser()
+    return _default_parser
+
+##
+# Marker for an InterpreterBase created without a parser argument
+# (None is an explicit "no parser")
+_DEFAULT_PARSER = object()
+
+##========================================================================
+
+##
+# Marker used by InterpreterBase._statement_to_token_structure(...)
+_BUILD_TOKENS = object()
+
+##========================================================================
+
+##
+# The command executors of each interpreter class, by class
+_command_executors_by_class = {}
+
+##
+# Returns a dictionary from command name to the executor for it
+# (the _execute_<cmd> method) for the given interpreter class.
+# This is built once per class by looking through it's methods
+def _command_executors( interpreter_class ):
+    executors = _command_executors_by_class.get( interpreter_class, None )
+    if executors is None:
+        prefix = "_execute_"
+        executors = {}
+        for name in dir( interpreter_class ):
+            if name.startswith( prefix ):
+                executors[ intern( name[ len(prefix): ] ) ] = getattr( interpreter_class, name )
+        _command_executors_by_class[ interpreter_class ] = executors
+    return executors
+
 ##========================================================================
 
 ##
@@ -28,33 +128,79 @@ import defining
 #    3) current Node
 class InterpreterBase( object ):
 
+    __slots__ = ( 'name',
+                  'parser',
+                  'state',
+                  'command_callbacks',
+                  '_last_reference',
+                  '_last_reference_token_structure' )
+
     ##
     # The state class
     class State( object ):
 
+        __slots__ = ( 'current_node',
+                      'toplevel_nodes',
+                      'prompts',
+                      'node_index',
+                      'nodes_by_token_structure' )
+
         ##
         # Create a new state with given top-level nodes
         # and prompts
+        #
+        # The state also keeps indices of the nodes in it's node graph
+        # by node id and by natural token structure (see index_node(...) )
         def __init__( self,
                       current_node = None,
-                      toplevel_nodes = [],
-                      prompts = [] ):
+                      toplevel_nodes = None,
+                      prompts = None ):
             self.current_node = current_node
-            self.toplevel_nodes = list(toplevel_nodes)
-            self.prompts = list(prompts)
+            self.toplevel_nodes = []
+            if toplevel_nodes is not None:
+                self.toplevel_nodes.extend( toplevel_nodes )
+            self.prompts = []
+            if prompts is not None:
+                self.prompts.extend( prompts )
+            self.node_index = {}
+            self.nodes_by_token_structure = {}
+            node_utilities.NodeVisitor(
+                visitor = self.index_node ).visit( self.toplevel_nodes )
+
+        ##
+        # Adds a node to the indices of this state.
+        # Every node added to the node graph must be indexed
+        def index_node( self, node ):
+            self.node_index[ node.node_id() ] = node
+            nodes = self.nodes_by_token_structure.setdefault(
+                node.natural_token_structure,
+                [] )
+            if node not in nodes:
+                nodes.append( node )
 
 
     ##
-    # Creates a new interpreter with a name and parser and state
+    # Creates a new interpreter with a name and parser and state.
+    # When no parser is given the (shared) default_parser() is used and
+    # without a state the interpreter gets a new empty State
     def __init__( self,
                   name,
-                  parser = parsing.Parser(),
+                  parser = _DEFAULT_PARSER,
                   state = None ):
+        if parser is _DEFAULT_PARSER:
+            parser = default_parser()
+        if state is None:
+            state = InterpreterBase.State()
         self.name = name
         self.parser = parser
         self.state = state
         self.command_callbacks = {}
 
+        # the last reference converted by _reference_token_structure(...)
+        # and it's TokenStructure
+        self._last_reference = None
+        self._last_reference_token_structure = None
+
 
     ##
     # returns true if this interpreter is done
@@ -71,6 +217,7 @@ class InterpreterBase( object ):
     def add_toplevel_node( self, node ):
         if self.state is not None:
             self.state.toplevel_nodes.append( node )
+            self.state.index_node( node )
         else:
             raise RuntimeError( "Can not add top-level node to finished/done interpreted with None state!" )
 
@@ -84,6 +231,7 @@ class InterpreterBase( object ):
     def add_command_callback( self,
                               cmd,
                               callback ):
+        cmd = _intern_name( cmd )
         if cmd not in self.command_callbacks:
             self.command_callbacks[ cmd ] = []
         self.command_callbacks[ cmd ].append( callback )
@@ -110,44 +258,18 @@ class InterpreterBase( object ):
     def _evaluate_expression( self, expr ):
 
         # Dispatch based on expression type
-        if self._expression_is_statement( expr ):
-            self._evaluate_statement( expr )
-        elif self._expression_is_command( expr ):
-            self._evaluate_command( expr )
-        elif self._expression_is_bind( expr ):
-            self._evaluate_bind( expr )
-        elif self._expression_is_context_expression( expr ):
-            self._evaluate_context_expression( expr )
+        handler = self._expression_handlers.get( _expression_kind( expr ), None )
+        if handler is not None:
+            getattr( self, handler )( expr )
         else:
             self.error_prompt( "Unknown expression type '{0}'".format( expr ) )
 
-
-    ##
-    # returns true if this is a Statement expression
-    def _expression_is_statement( self, expr ):
-        return expr.__class__.__name__ == 'Statement'
-    
-    ##
-    # returns true if this is a Command expression
-    def _expression_is_command( self, expr ):
-        return expr.__class__.__name__.endswith( 'Command' )
-
-    ##
-    # returns true if this is a Bind expression
-    def _expression_is_bind( self, expr ):
-        return expr.__class__.__name__ == 'BindExpression'
-
-    ##
-    # returns true if this is a ContextExpression expression
-    def _expression_is_context_expression( self, expr ):
-        return expr.__class__.__name__ == 'ContextExpression'
-
     ##
     # Evaluate a Command expression
     def _evaluate_command( self, expr ):
 
         # grab the command identifier
-        cmd = expr.cmd
+        cmd = _intern_name( expr.cmd )
 
         # ok, see if we have a registerd callbacks
         if cmd in self.command_callbacks:
@@ -157,18 +279,10 @@ class InterpreterBase( object ):
 
         else:
             
-            # now, lookup a method in this object
-            methodname = "_execute_{0}".format( cmd )
-            if not hasattr( self,
-                            methodname ):
-                self.error_prompt( "Unknwon Command encountered '{0}'".format(
-                    cmd ) )
-
-            # ok, grab the method and call it
-            if hasattr( self, methodname ):
-                executor = getattr( self,
-                                    methodname )
-                executor( cmd, expr.arg )
+            # now, lookup a method in this object and call it
+            executor = _command_executors( type(self) ).get( cmd, None )
+            if executor is not None:
+                executor( self, cmd, expr.arg )
             else:
 
                 # signal error of unknown command
@@ -181,7 +295,8 @@ class InterpreterBase( object ):
 
         # ok, we will jsut use hte current Node's context
         # and apply the binding
-        if self.state.current_node is None:
+        current_node = self.state.current_node
+        if current_node is None:
             self.error_prompt( "Can not evalute bind expression for identifier '{0}', not current Node to grab a Context from!".format( expr.slot ) )
             return
 
@@ -189,11 +304,13 @@ class InterpreterBase( object ):
         # it is a Plain-ol-datatype or a Reference
         value = expr.binding
 
+        value_kind = _expression_kind( value )
+
         # ok, PODs are easy
-        if isinstance( value, (str,unicode,bool,int,float)):
+        if isinstance( value, _POD_TYPES ):
 
             # jsut bind in contenxt of current node
-            self.state.current_node.bind(
+            current_node.bind(
                 expr.slot,
                 value )
             self.message_prompt( "Added POD Binding '{0}' = '{1}'".format(
@@ -201,7 +318,7 @@ class InterpreterBase( object ):
                 value ) )
 
         # Ok, see if we are an explicit reference
-        elif value.__class__.__name__ == 'ExplicitNodeReference':
+        elif value_kind == 'ExplicitNodeReference':
 
             # ok, find the node we are ferering to by id
             node = self._find_node_by_id( value.id )
@@ -212,7 +329,7 @@ class InterpreterBase( object ):
                 return
 
             # Ok, found node so make binding
-            self.state.current_node.bind(
+            current_node.bind(
                 expr.slot,
                 node )
             self.message_prompt( "Added binding of explicit node, slot '{0}' = node id={1}".format(
@@ -220,7 +337,7 @@ class InterpreterBase( object ):
                 node.node_id() ) )
 
         # Check if we are an implciit reference
-        elif value.__class__.__name__ == 'ImplicitReference':
+        elif value_kind == 'ImplicitReference':
 
             # try to find a node for hte implicit reference
             nodes = self.find_nodes_by_implicit_reference( value.ref )
@@ -239,17 +356,17 @@ class InterpreterBase( object ):
                 return
             
             # Ok, found node so make binding
-            self.state.current_node.bind(
+            current_node.bind(
                 expr.slot,
                 nodes[0] )
-            self.message_prompt( "Added binding from implicit references, slot '{0)' = node id={1}".format(
+            self.message_prompt( "Added binding from implicit references, slot '{0}' = node id={1}".format(
                 expr.slot,
                 nodes[0].node_id() ) )
             
         else:
 
             # unknown binding type
-            self.error_prompt( "Unknwon binding type '{0}', slot={1}, binding={2}".format( expr, expr,slot, expr.binding ) )
+            self.error_prompt( "Unknwon binding type '{0}', slot={1}, binding={2}".format( expr, expr.slot, expr.binding ) )
             return
 
 
@@ -264,11 +381,13 @@ class InterpreterBase( object ):
         # If no current node, ti will become the current
         # node and be a top-level node
         node = self._statement_to_node( expr )
-        if self.state.current_node is not None:
-            self.state.current_node.add_representation( node )
+        state = self.state
+        if state.current_node is not None:
+            state.current_node.add_representation( node )
+            state.index_node( node )
         else:
             self.add_toplevel_node( node )
-            self.state.current_node = node
+            state.current_node = node
 
     ##
     # Convert from a Statement to a Node representing it
@@ -279,40 +398,74 @@ class InterpreterBase( object ):
 
     ##
     # Convert a Statment to a TokenStructure
+    #
+    # This is done bottom-up with an explicit stack (rather than
+    # recursion) so deeply nested statements are fine.  When the parts
+    # of a list are pushed they are preceded by a _BUILD_TOKENS marker
+    # (and the number of parts) which, once all the parts are converted,
+    # builds the TokenStructure from them
+    #
+    # Most statements are flat (all of their parts are tokens) so those
+    # are built directly from their parts without the stack
     def _statement_to_token_structure( self, expr ):
 
-        # We will convert ubsstatments into TokenSequences :)
-        if isinstance( expr, list):
-            toks = map(lambda t: self._statement_to_token_structure( t ), expr )
-            return framework.TokenStructure( toks )
-
-        # A statement should become a tokensequence of hte parts
-        if expr.__class__.__name__ == 'Statement':
-
-            # special case where we only have a single Statement as part
+        if _expression_kind( expr ) == 'Statement':
+            parts = expr.parts
+            for p in parts:
+                if isinstance( p, list ) or _expression_kind( p ) == 'Statement':
+                    break
+            else:
+                return framework.TokenStructure( tuple( parts ) )
+
+        results = []
+        stack = [ expr ]
+        while len(stack) > 0:
+            e = stack.pop()
+
+            # all of the parts of a list are converted, so build it's
+            # TokenSequence from the last n results
+            if e is _BUILD_TOKENS:
+                start = len(results) - stack.pop()
+                toks = tuple( results[ start: ] )
+                del results[ start: ]
+                results.append( framework.TokenStructure( toks ) )
+                continue
+
+            # A statement should become a tokensequence of hte parts.
+            # Special case where we only have a single Statement as part
             # we will flatten this
-            if len( expr.parts ) == 1 and expr.parts[0].__class__.__name__ == 'Statement':
-                return self._statement_to_token_structure( expr.parts[0] )
-
-            # we jsut return the tokensewuence of the parts
-            return self._statement_to_token_structure( expr.parts )
+            while _expression_kind( e ) == 'Statement':
+                if len( e.parts ) == 1 and _expression_kind( e.parts[0] ) == 'Statement':
+                    e = e.parts[0]
+                else:
+                    e = e.parts
+
+            # We will convert ubsstatments into TokenSequences :)
+            if isinstance( e, list ):
+                stack.append( len(e) )
+                stack.append( _BUILD_TOKENS )
+                stack.extend( reversed( e ) )
+
+            # Ok, not a list or a Statment menas we are a token, pass thorugh
+            else:
+                results.append( e )
 
-        # Ok, not a list or a Statment menas we are a token, pass thorugh
-        return expr
+        return results[0]
 
 
     ##
     # Evaluate a ContextExpression
     def _evaluate_context_expression( self, expr ):
 
-        if self.state.current_node is None:
+        current_node = self.state.current_node
+        if current_node is None:
             self.error_prompt( "We cannot have a ContextExpression or Definition without having a current node" )
             return
 
         # Ok, we will simply attach the expression as
         # a python definition to the current node
-        pydef = defining.PythonDefinition(self.state.current_node,expr.body)
-        self.state.current_node.bind_definition( pydef )
+        pydef = defining.PythonDefinition(current_node,expr.body)
+        current_node.bind_definition( pydef )
         self.message_prompt( "Bound definition of current node" )
 
     ##
@@ -337,21 +490,21 @@ class InterpreterBase( object ):
     # We return the found node, or None
     def _find_node_by_id( self, node_id ):
 
-        # we will simply walk the node graph, returning when
-        # we have found a node with the given id
-        found_node = None
-        def _visit(node):
-            if node.node_id() == node_id:
-                found_node = node
-        def _terminate( q, visited):
-            return found_node is not None
-        node_visitor = node_utilities.NodeVisitor(
-            visitor=_visit,
-            terminator=_terminate )
-        node_visitor.visit( self.state.toplevel_nodes )
-
-        # ok, return found_node
-        return found_node
+        # nodes are indexed by id as they are added to the node graph
+        return self.state.node_index.get( node_id, None )
+
+    ##
+    # Returns the TokenStructure for a reference (a Statement).
+    #
+    # A reference is usually converted more than once in a row (to look
+    # it up and then to create a node for it) so we remember the last
+    # one converted.  Only the last one is kept (along with the
+    # reference itself) so this does not grow
+    def _reference_token_structure( self, reference ):
+        if reference is not self._last_reference:
+            self._last_reference_token_structure = self._statement_to_token_structure( reference )
+            self._last_reference = reference
+        return self._last_reference_token_structure
 
     ##
     # Find a node by an 'implicit" reference.
@@ -361,20 +514,13 @@ class InterpreterBase( object ):
 
         # ok, so a reference is a Statement so first grab the
         # TokenStructure for the references
-        ref_token_structure = self._statement_to_token_structure( reference )
+        ref_token_structure = self._reference_token_structure( reference )
 
         # now we will find all nodes in the node graph with the
-        # exct same token structure
-        found_nodes = []
-        def _visit(node):
-            if node.natural_token_structure == ref_token_structure:
-                found_nodes.append( node )
-        node_visitor = node_utilities.NodeVisitor(
-            visitor=_visit )
-        node_visitor.visit( self.state.toplevel_nodes )
-
-        # ok, return hte nodes
-        return found_nodes
+        # exct same token structure (they are indexed by it)
+        return list( self.state.nodes_by_token_structure.get(
+            ref_token_structure,
+            [] ) )
 
 
     ##
@@ -390,7 +536,7 @@ class InterpreterBase( object ):
     def _execute_enter( self, cmd, arg ):
 
         # ok, see what type of reference we have
-        if arg.__class__.__name__ == 'ExplicitNodeReference':
+        if _expression_kind( arg ) == 'ExplicitNodeReference':
 
             # ok, find the node we are ferering to by id
             node = self._find_node_by_id( arg.id )
@@ -405,7 +551,7 @@ class InterpreterBase( object ):
             self.message_prompt( "Changed current node to id={0}".format(
                 self.state.current_node.node_id() ) )
 
-        elif arg.__class__.__name__ == 'ImplicitReference':
+        elif _expression_kind( arg ) == 'ImplicitReference':
 
             # ok, so here we will try to find all the nodes referenced
             nodes = self.find_nodes_by_implicit_reference( arg.ref )
@@ -427,8 +573,9 @@ class InterpreterBase( object ):
                 # ok, having no found references means we want to make a new *piece*
                 # so let's make it
                 piece = framework.Node(
-                    self._statement_to_token_structure( arg.ref ) )
+                    self._reference_token_structure( arg.ref ) )
                 self.state.current_node.add_piece( piece )
+                self.state.index_node( piece )
 
                 # now we also want to set that piece as the current node :)
                 self.state.current_node = piece
@@ -446,12 +593,25 @@ class InterpreterBase( object ):
     # This will set hte current node to it's representation parent
     def _execute_leave( self, cmd, arg ):
 
-        if len(self.state.current_node.is_representation_of) > 0:
-            self.state.current_node = self.state.current_node.is_representation_of[0]
-        elif len(self.state.current_node.is_piece_of) > 0:
-            self.state.current_node = self.state.current_node.is_piece_of[0]
+        state = self.state
+        current_node = state.current_node
+        if len(current_node.is_representation_of) > 0:
+            state.current_node = current_node.is_representation_of[0]
+        elif len(current_node.is_piece_of) > 0:
+            state.current_node = current_node.is_piece_of[0]
         else:
             self.error_prompt( "Can't leave node with no parents!" )
+
+    ##
+    # The name of the evaluation method for each kind of expression
+    # (see _expression_kind(...) ). These are looked up on the
+    # interpreter so subclasses may override them
+    _expression_handlers = {
+        'Statement' : '_evaluate_statement',
+        'Command' : '_evaluate_command',
+        'BindExpression' : '_evaluate_bind',
+        'ContextExpression' : '_evaluate_context_expression',
+    }
         
 ##========================================================================
 
@@ -461,6 +621,8 @@ class InterpreterBase( object ):
 # message reporting as well as questions (yes/no or otherwise)
 class PromptBase( InterpreterBase ):
 
+    __slots__ = ( 'parent', )
+
     ##
     # Creates a new PromptBase with given interpreter as parent
     def __init__( self,
@@ -480,20 +642,60 @@ class PromptBase( InterpreterBase ):
 ##
 # A MessagePrompt which is just used to display something
 # to user
+#
+# Many messages are finished without ever being looked at, so the
+# State (with the message node) is only created the first time it
+# is asked for.
+#
+# Messages have no parser so they never interpret input themselves,
+# which means they only need their name, parent and message (we do not
+# run the full PromptBase/InterpreterBase initialization)
 class MessagePrompt( PromptBase ):
 
+    __slots__ = ( 'message', '_state', '_done' )
+
     ##
     # creates a new message prompt with given message
     def __init__( self,
                   name,
                   message,
                   parent ):
-        super( MessagePrompt, self ).__init__(
-            name = name,
-            parent = parent,
-            parser = None )
+        self.name = name
+        self.parent = parent
+        self.parser = None
+        self.command_callbacks = {}
+        self._last_reference = None
+        self._last_reference_token_structure = None
         self.message = message
-        self.add_toplevel_node( framework.message_node( message ) ) 
+        self._state = None
+        self._done = False
+
+    ##
+    # The State of this prompt, with the message node as it's
+    # top-level node. Created when first needed (None once finished)
+    @property
+    def state( self ):
+        if self._state is None and not self._done:
+            self._state = InterpreterBase.State(
+                toplevel_nodes = [ framework.message_node( self.message ) ] )
+        return self._state
+
+    @state.setter
+    def state( self, state ):
+        self._state = state
+        self._done = state is None
+
+    ##
+    # A message is done once finished, whether or not it's State
+    # was ever created
+    def is_done( self ):
+        return self._done
+
+    ##
+    # Finish this message
+    def finish( self ):
+        self._done = True
+        self._state = None
 
 ##========================================================================
 
@@ -501,6 +703,8 @@ class MessagePrompt( PromptBase ):
 # As ErrorPrompt which is just used to diplay na error to hte user
 class ErrorPrompt( MessagePrompt ):
 
+    __slots__ = ()
+
     ##
     # creates a new prompt with given error message
     def __init__( self,
@@ -512,6 +716,25 @@ class ErrorPrompt( MessagePrompt ):
             message = message,
             parent = parent)
 
+##========================================================================
+
+##
+# Messages do not run the InterpreterBase initialization but still
+# have everything an interpreter needs, such as command callbacks
+def test_message_prompt_callback():
+
+    calls = []
+    parent = InterpreterBase( 'parent', parser = None )
+    for p in [ MessagePrompt( 'message', 'hello', parent ),
+               ErrorPrompt( 'error', 'oops', parent ) ]:
+        p.add_command_callback(
+            'show',
+            lambda interp, cmd, arg: calls.append( ( interp, cmd, arg ) ) )
+        assert len( p.command_callbacks[ 'show' ] ) == 1
+        assert p._last_reference is None
+        assert p._last_reference_token_structure is None
+    return calls
+
 ##========================================================================
 ##========================================================================
 ##========================================================================
@@ -13,6 +13,7 @@ logger = logging.getLogger( __name__ )
 # Most important is the Visitor pattern for searching the node graph
 
 import collections
+import itertools
 
 ##========================================================================
 
@@ -20,19 +21,34 @@ import collections
 # A simple inserter for a NodeVisitor which performsn Bread-First-Search
 #
 # Note: the *end* element of the q is the next one to be visited
-def bfs_inserter( q, children ):
+#       (the q is a collections.deque)
+#
+# enqueued is the set of nodes in the q, so we can check for
+# children already in the q without searching it
+def bfs_inserter( q, children, enqueued ):
     for c in reversed(children):
-        if c not in q:
+        if c not in enqueued:
             q.append( c )
+            enqueued.add( c )
     return q
 
 ##========================================================================
 
 ##
 # An expander for the NodeVisitor which just expands both
-# repreentations and parts, representations first
+# repreentations and parts, representations first.
+#
+# The children are returned as an iterable (not a new list), the
+# visitor only goes through them once
 def all_children_expander( node ):
-    return node.representations + node.pieces
+    return itertools.chain( node.representations, node.pieces )
+
+##========================================================================
+
+##
+# The types of roots given to NodeVisitor.visit(...) which are
+# known to be sequences of roots
+_ROOT_SEQUENCE_TYPES = ( list, tuple, collections.deque )
 
 ##========================================================================
 
@@ -49,6 +65,12 @@ def all_children_expander( node ):
 #   4) "Insert" the not-already-visited children into the q
 #
 # Note: the *end* of hte q (last element) is popped and used at every visitation
+#       The q is a collections.deque, so q_inserters may also cheaply
+#       add to (or take from) it's front
+#
+# The visitor keeps the set of nodes currently in the q ("enqueued")
+# which is given to the q_inserter, which must add any node it puts
+# in the q to it
 class NodeVisitor( object ):
 
     ##
@@ -63,36 +85,50 @@ class NodeVisitor( object ):
         self.visitor = visitor
         self.expander = expander
         self.terminator = terminator
-        self.q = []
+        self.q = collections.deque()
         self.already_visited = set([])
+        self.enqueued = set([])
 
     ##
     # Start a visiting pattern from the given list of
     # nodes as "roots"
     def visit( self, roots ):
 
-        # make sure roots is a list
-        if not isinstance( roots, collections.Iterable ):
-            roots = [ roots ]
+        # make sure roots is a list (or other iterable).
+        # The common sequence types are checked first since the
+        # Iterable ABC check is much slower
+        if not isinstance( roots, _ROOT_SEQUENCE_TYPES ):
+            if not isinstance( roots, collections.Iterable ):
+                roots = [ roots ]
 
         # ok, we add all roots to the q
-        self.q.extend( roots )
+        for r in roots:
+            self.q.append( r )
+            self.enqueued.add( r )
 
         # now we just perform our loop
+        visited = self.already_visited
         while not self._is_done():
 
             # grab first node in q
             node = self.q.pop()
-            self.already_visited.add( node )
+            self.enqueued.discard( node )
+            visited.add( node )
 
             # visit hte node
             self._visit( node )
 
+            # if the visit finished the walk (such as finding what we
+            # were looking for) stop now rather than expanding children
+            if self._is_terminated():
+                return
+
             # expand children
             children = self._expand_children( node )
 
             # filter children to those not alredy visited
-            children = filter(lambda c: c not in self.already_visited, children)
+            # (this is the only list of them made)
+            children = [ c for c in children if c not in visited ]
 
             # add children to q
             self._add_children_to_q( children )
@@ -104,15 +140,22 @@ class NodeVisitor( object ):
     def _is_done(self):
 
         # use temrinator if we hve it
-        if self.terminator is not None:
-            tres = self.terminator( self.q, self.already_visited )
-            if tres:
-                return tres
+        if self._is_terminated():
+            return True
 
         # Ok, even if we have a terminator, if it returns false but
         # there is nothing in the q we are done
         return len(self.q) == 0
 
+    ##
+    # returns true iff the given termination function (if any) says
+    # we are done
+    def _is_terminated(self):
+        if self.terminator is not None:
+            if self.terminator( self.q, self.already_visited ):
+                return True
+        return False
+
     ##
     # "visit" the given node.
     # Usually jsut forward to the given visitor
@@ -121,20 +164,19 @@ class NodeVisitor( object ):
             self.visitor( node )
 
     ##
-    # Expand and return the children for a node.
+    # Expand and return the children (an iterable) for a node.
     # Just forwards to the expander
     def _expand_children( self, node ):
         if self.expander is not None:
-            children = self.expander( node )
-            return children
-        return []
+            return self.expander( node )
+        return ()
 
     ##
     # Add the given children to the q.
     # This will invoke our q_inserter and replace the q
     def _add_children_to_q( self, children):
         if self.q_inserter is not None:
-            self.q = self.q_inserter( self.q, children )
+            self.q = self.q_inserter( self.q, children, self.enqueued )
 
 ##========================================================================
 ##========================================================================
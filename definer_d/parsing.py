@@ -11,12 +11,26 @@ logger = logging.getLogger( __name__ )
 # This file contains the parsing interface to go from
 # raw input into a Script structure
 
-import collections
-
 import textx.metamodel
 
 ##========================================================================
 
+##
+# The compiled TextX metamodels, keyed by grammar file path.
+# Compiling a grammar is expensive so we only ever do it once per file
+_metamodels = {}
+
+##
+# Returns the (cached) compiled metamodel for the given grammar file
+def _load_metamodel( grammar_file ):
+    mm = _metamodels.get( grammar_file, None )
+    if mm is None:
+        mm = textx.metamodel.metamodel_from_file( grammar_file )
+        _metamodels[ grammar_file ] = mm
+    return mm
+
+##========================================================================
+
 ##
 # A Parser is just an encompsulation of a grammar and can
 # also parse raw input
@@ -27,7 +41,7 @@ class Parser( object ):
     def __init__( self,
                   grammar_file = 'grammar.tx' ):
         self.grammar_file = grammar_file
-        self.metamodel = textx.metamodel.metamodel_from_file( 'grammar.tx' )
+        self.metamodel = _load_metamodel( grammar_file )
 
     ##
     # Parse a full string of raw input.
@@ -44,39 +58,50 @@ class Parser( object ):
 
 ##
 # returns a full stirng repreentation of a parsed expression
+#
+# The string is built as a list of fragments joined once at the end,
+# walking the expression with an explicit stack of
+# ( is_fragment, value ) items so deep expressions neither recurse nor
+# copy the string built so far
 def expression_full_string( expr ):
+    parts = []
+    stack = [ ( False, expr ) ]
+    while len(stack) > 0:
+        is_fragment, e = stack.pop()
+        if is_fragment:
+            parts.append( e )
+            continue
+
+        # ok, if we are a sequence then the string representation of
+        # each element, comma separated
+        if isinstance( e, (list,tuple) ):
+            items = [ ( True, u"[" ) ]
+            for i, v in enumerate( e ):
+                if i > 0:
+                    items.append( ( True, u"," ) )
+                items.append( ( False, v ) )
+            items.append( ( True, u"]" ) )
+            stack.extend( reversed( items ) )
+            continue
+
+        # ok, check if we are not an instance of a textx class, in which case
+        # we will return the string representation of this object
+        if not isinstance( e, textx.metamodel.TextXClass ):
+            parts.append( unicode( e ) )
+            continue
+
+        # Ok, we are a textx class so find all the fields (if any) and
+        # return them as a dictionary tring representation
+        items = [ ( True, u"EXPR[" ) ]
+        for i, f in enumerate( e._tx_attrs ):
+            if i > 0:
+                items.append( ( True, u"  " ) )
+            items.append( ( True, u"{0}=".format( f ) ) )
+            items.append( ( False, getattr( e, f ) ) )
+        items.append( ( True, u"]" ) )
+        stack.extend( reversed( items ) )
 
-    # ok, if we are a sequence then return string representation of
-    # mapping with expression_full_string
-    if isinstance( expr, (list,tuple) ):
-        res = map(expression_full_string, expr )
-        s = u"["
-        for i, v in enumerate(res):
-            s += v
-            if i < len(res) - 1:
-                s += u","
-        s += u"]"
-        return s
-
-    # ok, check if we are not an instance of a textx class, in which case
-    # we will return the string representation of this object
-    if not isinstance( expr, textx.metamodel.TextXClass ):
-        return unicode( expr )
-
-    # Ok, we are a textx class so find all the fields (if any) and
-    # return them as a dictionary tring representation
-    fields = expr._tx_attrs
-    field_map = collections.OrderedDict()
-    for f in fields:
-        v = getattr( expr, f )
-        field_map[ f ] = expression_full_string( v )
-    s = u"EXPR["
-    for i, (f, v) in enumerate(field_map.iteritems()):
-        s += u"{0}={1}".format( f, v )
-        if i < len(field_map) - 1:
-            s += u"  "
-    s += u"]"
-    return s
+    return u"".join( parts )
 
 ##========================================================================
 ##========================================================================
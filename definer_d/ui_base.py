@@ -16,6 +16,20 @@ import interpreting
 
 ##========================================================================
 
+##
+# The indent strings used when showing nodes, by depth
+_INDENTS = tuple( " " * ( 4 * d ) for d in xrange( 64 ) )
+
+##
+# Returns the indent string for the given indent (number of spaces)
+def _indent_string( indent ):
+    depth = indent // 4
+    if indent % 4 == 0 and depth < len(_INDENTS):
+        return _INDENTS[ depth ]
+    return " " * indent
+
+##========================================================================
+
 ##
 # The basci UI which just displays the top-level nodes of prompts
 # and feeds one line of input to the interpreter
@@ -54,50 +68,65 @@ class BasicUI( object ):
 
     ##
     # Show the prompts for the current interpreter
+    #
+    # The output is collected and written with a single writelines
     def show_prompts( self, out_stream ):
 
+        parts = []
+
         # first show any prompts form interpreter
         for i, p in enumerate(self.interpreter.state.prompts):
             for j, node in enumerate(p.state.toplevel_nodes):
-                out_stream.write( "{0:02d}.{1:02d}) {2}\n".format(
+                parts.append( "{0:02d}.{1:02d}) {2}\n".format(
                     i, j, node.natural_token_structure.human_friendly() ) )
-            out_stream.write( "\n" )
+            parts.append( "\n" )
 
         # now show the current node
-        self.show_current_node( out_stream )
+        self._current_node_lines( parts )
 
         # show the interpreter name and prompt for input
-        out_stream.write( "{0}>> ".format(self.interpreter.name) )
+        parts.append( "{0}>> ".format(self.interpreter.name) )
+
+        out_stream.writelines( parts )
 
     ##
     # Show the cufrent node and it's representations and parts
     def show_current_node( self, out_stream ):
 
+        parts = []
+        self._current_node_lines( parts )
+        out_stream.writelines( parts )
+
+    ##
+    # Adds the lines showing the current node (if any) to parts
+    def _current_node_lines( self, parts ):
+
         node = self.interpreter.state.current_node
         if node is not None:
-            self._show_node( node, out_stream )
+            self._node_lines( node, parts )
 
     ##
-    # Show the given node to out_stream
-    def _show_node( self, node, out_stream, indent=0, path="*" ):
-
-        indent_string = " " * indent
-        path_string = "{0}[id={1}] ".format(path, node.node_id())
-        out_stream.write( indent_string + path_string + node.natural_token_structure.human_friendly() )
-        out_stream.write( "\n" )
+    # Adds the lines showing the given node to parts
+    def _node_lines( self, node, parts, indent=0, path="*" ):
+
+        parts.append( "{0}{1}[id={2}] {3}\n".format(
+            _indent_string( indent ),
+            path,
+            node.node_id(),
+            node.natural_token_structure.human_friendly() ) )
         for i,r in enumerate(node.representations):
-            self._show_node( r, out_stream, indent + 4, path + ".rep" + str(i))
+            self._node_lines( r, parts, indent + 4, path + ".rep" + str(i))
         for i,r in enumerate(node.pieces):
-            self._show_node( r, out_stream, indent + 4, path + ".piece" + str(i) )
+            self._node_lines( r, parts, indent + 4, path + ".piece" + str(i) )
 
 
     ##
     # Finish and remove hte prompts
     def finish_prompts(self):
-        for p in self.interpreter.state.prompts:
+        prompts = self.interpreter.state.prompts
+        for p in prompts:
             p.finish()
-        del self.interpreter.state.prompts[:]
-        self.interpreter.state.prompts = []
+        del prompts[:]
 
     ##
     # read a line of input
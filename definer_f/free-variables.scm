@@ -3,11 +3,23 @@
 (use-modules (language tree-il)
 	     (ice-9 optargs))
 
+;;;
+;;; Flattens a (possibly nested) list into a flat list of it's atoms.
+;;; This walks the tree once using an explicit stack of pending subtrees
+;;; and conses atoms onto an accumulator, rather than recursing and
+;;; re-appending every flattened sublist
 (define (flatten x)
-    (cond ((null? x) '())
-          ((not (pair? x)) (list x))
-          (else (append (flatten (car x))
-                        (flatten (cdr x))))))
+  (let loop ((stack (list x))
+             (acc '()))
+    (cond ((null? stack) (reverse acc))
+          ((null? (car stack)) (loop (cdr stack) acc))
+          ((pair? (car stack))
+           (loop (cons (car (car stack))
+                       (cons (cdr (car stack))
+                             (cdr stack)))
+                 acc))
+          (else (loop (cdr stack)
+                      (cons (car stack) acc))))))
  
 ;;;
 ;;; A stack of "environments" is just a list of lists